@@ -0,0 +1,98 @@
+"""
+Compare the old BeautifulSoup + str(tag) + regex extraction with scrapers.extract on saved pages.
+Run from the repo root: python -m benchmarks.bench_extract [number of runs]
+"""
+import os
+import re
+import sys
+from timeit import timeit
+
+from bs4 import BeautifulSoup
+
+from scrapers.kvartirant_scraper_new import KvartirantScraper
+from scrapers.onliner_details import SUBCLASSES, parse_details
+from scrapers.realt_scraper import RealtScraper
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+# the way the scrapers did it before - kept here as the baseline
+
+
+def legacy_clean_html(raw_html: str) -> str:
+    clean_regex = re.compile('<.*?>')
+    clean_text = re.sub(clean_regex, '', raw_html)
+    clean_text = re.sub(r'(?:\n|\s{2,})', ' ', clean_text)
+    return clean_text.strip()
+
+
+def legacy_realt(page: str) -> list:
+    soup = BeautifulSoup(page, 'html.parser')
+    descriptions = soup.find_all('div', {'class': 'bd-item-right'})
+    titles = soup.find_all('div', {'class': 'title'})
+    prices = soup.find_all('span', {'class': 'price-byr'})
+    rows = []
+    for i in range(len(titles)):
+        address = legacy_clean_html(str(titles[i]))
+        url = re.compile(r'(a href=")(.+?)(")').findall(str(titles[i]))[0][1]
+        description = legacy_clean_html(str(descriptions[i]))
+        tel_no = re.findall(r'\+\d{3}[\s-]\d{2}[\s-]\d{3}[\s-]\d{2}[\s-]\d{2}', description)
+        rows.append((url.split('/')[-2], url, address, description, legacy_clean_html(str(prices[i])), tel_no))
+    return rows
+
+
+def legacy_kvartirant(page: str) -> list:
+    soup = BeautifulSoup(page, 'html.parser')
+    titles = soup.find_all('div', {'class': 'title-obj'})
+    descriptions = soup.find_all('div', {'class': 'bottom'})
+    owners = soup.find_all('p', {'class': 'landlords'})
+    prices = soup.find_all('p', {'class': 'price'})
+    rows = []
+    for title, description, owner, price in zip(titles, descriptions, owners, prices):
+        url = re.compile(r"a href=\"(.+?)\"").findall(str(title))[0]
+        rows.append((url, legacy_clean_html(str(title)), legacy_clean_html(str(description)),
+                     legacy_clean_html(str(owner)), legacy_clean_html(str(price)),
+                     re.findall(r"(\d+\$.+?)\"", str(price))))
+    return rows
+
+
+def legacy_onliner(page: str) -> list:
+    soup = BeautifulSoup(page, 'html.parser')
+    elements = []
+    for element in SUBCLASSES:
+        ls = soup.find_all('div', {'class': SUBCLASSES[element]})
+        if element == 'Присутствует/отсутствует':
+            temp = [('++' if 'lack' not in str(item) else '--') + legacy_clean_html(str(item)) for item in ls]
+        elif element == 'Номера телефонов':
+            temp = [legacy_clean_html(str(item)).replace(' ', '').replace('-', '').replace('+', '\n+') for item in ls]
+        else:
+            temp = [legacy_clean_html(str(item)) for item in ls]
+        elements.append((element, '\n'.join(temp)))
+    return elements
+
+
+CASES = [
+    ('realt search page', 'realt_search.html', legacy_realt, RealtScraper.parse_page),
+    ('kvartirant search page', 'kvartirant_search.html', legacy_kvartirant, KvartirantScraper.parse_page),
+    ('onliner apartment page', 'onliner_apartment.html', legacy_onliner, parse_details),
+]
+
+
+def main(runs: int = 50) -> None:
+    print('{:<24}{:>8}{:>14}{:>14}{:>10}'.format('page', 'items', 'legacy, ms', 'lxml, ms', 'speedup'))
+    for name, fixture, legacy, current in CASES:
+        page = load(fixture)
+        items = len(current(page)[0] if current is parse_details else current(page))
+        legacy_ms = timeit(lambda: legacy(page), number=runs) / runs * 1000
+        current_ms = timeit(lambda: current(page), number=runs) / runs * 1000
+        print('{:<24}{:>8}{:>14.2f}{:>14.2f}{:>9.1f}x'.format(name, items, legacy_ms, current_ms,
+                                                              legacy_ms / current_ms))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
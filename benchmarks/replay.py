@@ -0,0 +1,84 @@
+"""
+Replay of an archive of raw responses through the scrapers, dedup and a chat filter, as fast as the CPU allows.
+Record with "archive_dir" in the bot config (or run_benchmarks --record DIR), then from the repo root:
+python -m benchmarks.replay --archive ./archive --filter "2_room <400 owner"
+"""
+import argparse
+import os
+import tempfile
+from time import perf_counter
+
+from scrapers.archive import ArchiveReader, ReplayExhausted, ReplayFetcher
+from scrapers.dedup import Duplicates
+from scrapers.http_client import set_fetcher
+from scrapers.kvartirant_scraper_new import KvartirantScraper
+from scrapers.onliner_scraper import OnlinerScraper
+from scrapers.parse_pool import ParseExecutor
+from scrapers.realt_scraper import RealtScraper
+from scrapers.seen_store import SeenStore
+from scrapers.subscriptions import ChatFilter, Subscriptions
+
+SCRAPERS = [('onliner', OnlinerScraper), ('realt', RealtScraper), ('kvartirant', KvartirantScraper)]
+CHAT = 1  # the only subscriber of the replay
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--archive', default='./archive')
+    arg_parser.add_argument('--since', type=float, default=0.0, help='unix time of the first response to replay')
+    arg_parser.add_argument('--until', type=float, default=float('inf'))
+    arg_parser.add_argument('--filter', default='', help='chat filter, as in /start')
+    arg_parser.add_argument('--source', choices=[s[0] for s in SCRAPERS], action='append',
+                            help='replay only these scrapers')
+    args = arg_parser.parse_args()
+
+    fetcher = ReplayFetcher(ArchiveReader(args.archive).records(args.since, args.until))
+    set_fetcher(fetcher)
+    duplicates = Duplicates(clock=fetcher.clock)  # the replay clock moves with the replayed responses
+    parse_executor = ParseExecutor(0)
+    with tempfile.TemporaryDirectory() as db_dir:
+        subscriptions = Subscriptions(SeenStore(os.path.join(db_dir, 'subscriptions.db')))
+        subscriptions.subscribe(CHAT, ChatFilter.parse(args.filter.split()))
+        scrapers = [(name, scraper_class(store=SeenStore(os.path.join(db_dir, name + '.db')),
+                                         parse_executor=parse_executor, clock=fetcher.clock))
+                    for name, scraper_class in SCRAPERS if not args.source or name in args.source]
+        stats = {name: {'ticks': 0, 'errors': 0, 'listings': 0, 'duplicates': 0, 'matched': 0}
+                 for name, _ in scrapers}
+
+        started = perf_counter()
+        while scrapers:  # the scraper furthest behind in the recorded time ticks next, until the archive is over
+            name, scraper = min(scrapers, key=lambda item: fetcher.times.get(item[0], float('-inf')))
+            fetcher.resume(name)
+            replayed = fetcher.replayed
+            try:
+                listings = scraper.main()
+            except ReplayExhausted:
+                scrapers.remove((name, scraper))
+                continue
+            except Exception:
+                listings = None
+            if fetcher.replayed == replayed:  # nothing recorded for the tick around this time, not an error
+                try:
+                    fetcher.skip_gap(name)
+                except ReplayExhausted:
+                    scrapers.remove((name, scraper))
+                continue
+            if listings is None:
+                stats[name]['errors'] += 1
+                continue
+            stats[name]['ticks'] += 1
+            duplicates.merge(listings)
+            stats[name]['listings'] += len(listings)
+            stats[name]['duplicates'] += sum(1 for listing in listings if listing.links)
+            stats[name]['matched'] += sum(1 for listing in listings if CHAT in subscriptions.match(listing))
+        elapsed = perf_counter() - started
+
+    print('{:<12}{:>8}{:>8}{:>10}{:>12}{:>9}'.format('source', 'ticks', 'errors', 'listings', 'duplicates', 'matched'))
+    for name, r in stats.items():
+        print('{:<12}{ticks:>8}{errors:>8}{listings:>10}{duplicates:>12}{matched:>9}'.format(name, **r))
+    print('{} responses replayed in {:.2f}s, {:.0f} responses/s, {} requests not recorded'.format(
+        fetcher.replayed, elapsed, fetcher.replayed / elapsed if elapsed else 0, fetcher.misses))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Offline benchmark of the scrapers against the local stub server, no network is used.
+Run from the repo root: python -m benchmarks.run_benchmarks --ticks 50 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import math
+import os
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+from benchmarks.stub_server import StubServer
+from scrapers.archive import ArchiveWriter
+from scrapers.http_client import get_fetcher
+from scrapers.kvartirant_scraper_new import KvartirantScraper
+from scrapers.metrics import get_metrics
+from scrapers.onliner_scraper import OnlinerScraper
+from scrapers.parse_pool import ParseExecutor
+from scrapers.realt_scraper import RealtScraper
+from scrapers.seen_store import SeenStore
+
+# scraper class, attribute with the site url, path of the page on the stub server
+SCRAPERS = [
+    ('onliner', OnlinerScraper, 'SEARCH_URL', '/search/apartments'),
+    ('realt', RealtScraper, 'SEARCH_URL', '/rent/flat-for-long/'),
+    ('kvartirant', KvartirantScraper, 'PAGE_URL', '/ads/flats/rent/?page={}'),
+]
+
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(share * len(ordered)) - 1)]
+
+
+def parse_time(name: str) -> float:
+    """Seconds the scraper has spent parsing so far, onliner detail pages are counted under their own source"""
+    metrics = get_metrics()
+    return metrics.total(name, 'parse') + (metrics.total('onliner_details', 'parse') if name == 'onliner' else 0)
+
+
+def bench(name: str, scraper_class, url_attr: str, path: str, server: StubServer, ticks: int, db_dir: str,
+          parse_executor: ParseExecutor) -> dict:
+    scraper = scraper_class(store=SeenStore(os.path.join(db_dir, name + '.db')), parse_executor=parse_executor)
+    setattr(scraper, url_attr, server.base_url + path)
+
+    fetcher = get_fetcher()
+    try:
+        fetcher.run(scraper.main_async())  # cold start is not measured
+    except Exception:
+        pass  # stub error at the cold start doesn't matter
+    parse_before = parse_time(name)
+    requests_before = server.requests
+
+    latencies = []
+    errors = 0
+    tracemalloc.start()
+    started = perf_counter()
+    for _ in range(ticks):
+        tick_start = perf_counter()
+        try:
+            fetcher.run(scraper.main_async())
+        except Exception:
+            errors += 1
+        latencies.append(perf_counter() - tick_start)
+    elapsed = perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'source': name, 'ticks': ticks, 'errors': errors, 'ticks_per_s': ticks / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000,
+            'parse_ms': (parse_time(name) - parse_before) / ticks * 1000, 'peak_mib': peak / 2 ** 20,
+            'requests': (server.requests - requests_before) / ticks}
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--ticks', type=int, default=30)
+    arg_parser.add_argument('--latency', type=float, default=0.05, help='seconds per response of the stub server')
+    arg_parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency, seconds')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help='share of "500" responses')
+    arg_parser.add_argument('--new-per-tick', type=int, default=5, help='fresh listings in every search response')
+    arg_parser.add_argument('--parse-workers', type=int, default=0, help='processes for parsing, 0 - parse inline')
+    arg_parser.add_argument('--record', metavar='DIR', help='archive all the responses here, see benchmarks.replay')
+    arg_parser.add_argument('--source', choices=[s[0] for s in SCRAPERS], action='append',
+                            help='benchmark only these scrapers')
+    args = arg_parser.parse_args()
+
+    server = StubServer(args.latency, args.jitter, args.error_rate, args.new_per_tick).start()
+    parse_executor = ParseExecutor(args.parse_workers)
+    parse_executor.start()  # not timed as part of the first tick
+    if args.record:
+        get_fetcher().recorder = ArchiveWriter(args.record)
+    print('{:<12}{:>7}{:>8}{:>9}{:>10}{:>10}{:>11}{:>11}{:>10}'.format(
+        'source', 'ticks', 'errors', 'ticks/s', 'p50, ms', 'p99, ms', 'parse, ms', 'peak, MiB', 'req/tick'))
+    with tempfile.TemporaryDirectory() as db_dir:
+        for name, scraper_class, url_attr, path in SCRAPERS:
+            if args.source and name not in args.source:
+                continue
+            r = bench(name, scraper_class, url_attr, path, server, args.ticks, db_dir, parse_executor)
+            print('{source:<12}{ticks:>7}{errors:>8}{ticks_per_s:>9.1f}{p50_ms:>10.1f}{p99_ms:>10.1f}'
+                  '{parse_ms:>11.2f}{peak_mib:>11.2f}{requests:>10.1f}'.format(**r))
+    server.stop()
+    parse_executor.close()
+    if args.record:
+        get_fetcher().recorder.close()
+    get_fetcher().close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import json
+import random
+import re
+import threading
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.bench_extract import load
+
+REALT_ID_RE = re.compile(r'(/object/)(\d+)(/)')
+KVARTIRANT_ID_RE = re.compile(r'(/rent/)(\d+)(/)')
+REALT_DATE_RE = re.compile(r'Обновлено: \d\d\.\d\d\.\d{4}')
+
+
+class StubServer:
+    """
+    Local http server replaying the recorded pages of all three sites with configurable latency and errors.
+    Every response to a search page has new_per_tick fresh listings at the top, so scrapers do real work each tick.
+    """
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0, new_per_tick: int = 5,
+                 kvartirant_pages: int = 5, onliner_pages: int = 3):
+        self.latency = latency  # seconds
+        self.jitter = jitter  # seconds, added at random to the latency
+        self.error_rate = error_rate  # share of "500" responses
+        self.new_per_tick = new_per_tick
+        self.kvartirant_pages = kvartirant_pages
+        self.onliner_pages = onliner_pages
+        self.requests = 0
+        self._ticks = {'onliner': 0, 'realt': 0, 'kvartirant': 0}
+        self._lock = threading.Lock()
+
+        self.onliner_search = json.loads(load('onliner_search.json'))
+        self.onliner_apartment = load('onliner_apartment.html')
+        self.realt_search = REALT_DATE_RE.sub('Обновлено: ' + date.today().strftime('%d.%m.%Y'),
+                                              load('realt_search.html'))
+        self.kvartirant_search = load('kvartirant_search.html')
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stub-server', daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self) -> 'StubServer':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_tick(self, source: str) -> int:
+        with self._lock:
+            self._ticks[source] += 1
+            return self._ticks[source]
+
+    def _fresh_ids(self, regexp, page: str, tick: int, shift: int = 0) -> str:
+        """Listing ids shifted by the page number, the first new_per_tick ones also by the tick number"""
+        seen = {}
+
+        def replace(match):
+            idn = int(match.group(2)) + shift
+            if len(seen) < self.new_per_tick or match.group(2) in seen:
+                idn = seen.setdefault(match.group(2), idn + tick * 10 ** 7)
+            return '{}{}{}'.format(match.group(1), idn, match.group(3))
+        return regexp.sub(replace, page)
+
+    def onliner(self, page_num: int) -> str:
+        tick = self._next_tick('onliner') if page_num == 1 else 0  # just upped apartments are on the first page
+        now = datetime.now(timezone(timedelta(hours=3))).strftime('%Y-%m-%dT%H:%M:%S+0300')
+        apartments = []
+        for i, apartment in enumerate(self.onliner_search['apartments']):
+            apartment = dict(apartment, url=apartment['url'].replace('https://r.onliner.by', self.base_url))
+            apartment['id'] += (page_num - 1) * 1000
+            if tick and i < self.new_per_tick:
+                apartment['id'] = apartment['id'] + tick * 10 ** 7
+                apartment['url'] = '{}/ak/apartments/{}'.format(self.base_url, apartment['id'])
+                apartment['last_time_up'] = now
+            apartments.append(apartment)
+        page = dict(self.onliner_search['page'], current=page_num, last=self.onliner_pages)
+        return json.dumps(dict(self.onliner_search, apartments=apartments, page=page), ensure_ascii=False)
+
+    def realt(self) -> str:
+        return self._fresh_ids(REALT_ID_RE, self.realt_search, self._next_tick('realt'))
+
+    def kvartirant(self, page_num: int) -> str:
+        if page_num > self.kvartirant_pages:
+            return '<html><body></body></html>'
+        tick = self._next_tick('kvartirant') if page_num == 1 else 0  # new listings show up on the first page
+        return self._fresh_ids(KVARTIRANT_ID_RE, self.kvartirant_search, tick, shift=page_num * 1000)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                sleep(stub.latency + random.random() * stub.jitter)
+                if random.random() < stub.error_rate:
+                    self._send(500, 'text/plain', 'stub error')
+                    return
+                url = urlparse(self.path)
+                if url.path.startswith('/search/apartments'):
+                    page_num = int(parse_qs(url.query).get('page', ['1'])[0])
+                    self._send(200, 'application/json', stub.onliner(page_num))
+                elif url.path.startswith('/ak/apartments/'):
+                    self._send(200, 'text/html', stub.onliner_apartment)
+                elif url.path.startswith('/rent/flat-for-long'):
+                    self._send(200, 'text/html', stub.realt())
+                elif url.path.startswith('/ads/flats/rent'):
+                    page_num = int(parse_qs(url.query).get('page', ['1'])[0])
+                    self._send(200, 'text/html', stub.kvartirant(page_num))
+                else:
+                    self._send(404, 'text/plain', 'not found')
+
+            def _send(self, status: int, content_type: str, body: str) -> None:
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type + '; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+        return Handler
@@ -1,57 +1,226 @@
-import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from importlib import import_module
+from time import perf_counter
+from telegram.error import BadRequest, Unauthorized
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, InlineQueryHandler
-from scrapers.onliner_scraper import OnlinerScraper
-from scrapers.realt_scraper import RealtScraper
-from scrapers.kvartirant_scraper_new import KvartirantScraper
-
-OS = OnlinerScraper()
-RS = RealtScraper()
-KS = KvartirantScraper()
-
-config_params = json.load(open("./configs/config_and_cookies.json", 'r'))
-
-KEY = config_params['bot_key']
-
-
-def get_apartments_onliner(bot, job):
-    cnt = next(OS.main())
-    if cnt:
-        job.context.message.reply_text(cnt)
-
-
-def get_apartments_realt(bot, job):
-    cnt = next(RS.main())
-    if cnt:
-        job.context.message.reply_text('REALT UPDATE\n' + cnt[:2000])
-
-
-def get_apartments_kvartirant(bot, job):
-    cnt = next(KS.main())
-    if cnt:
-        job.context.message.reply_text('KVARTIRANT UPDATE\n' + cnt[:2000])
-
-
-def start(bot, update, job_queue):
-    update.message.reply_text('bot active')
-    job = job_queue.run_repeating(get_apartments_onliner, 10, context=update)
-    job = job_queue.run_repeating(get_apartments_realt, 60, context=update)
-    job = job_queue.run_repeating(get_apartments_kvartirant, 60, context=update)  # site changed
-
-
-def stop(bot, update, job_queue):
-    update.message.reply_text('bot disabled')
-    job = job_queue.stop()
+from scrapers.config import get_config
+from scrapers.dedup import Duplicates
+from scrapers.listing_index import ListingIndex, parse_query
+from scrapers.metrics import METRICS_PATH, get_metrics
+from scrapers.scheduler import AdaptiveSchedule
+from scrapers.send_queue import SendQueue
+from scrapers.subscriptions import ChatFilter, Subscriptions
+
+# scrapers (aiohttp, lxml) and their stores are heavy, so they are imported and built in the warm-up threads
+# while the bot already answers commands.
+# name, module and class of the scraper, its polling schedule (first interval, min, max, requests per hour),
+# other sources whose requests are paid from its budget, header of its messages
+SOURCES = [
+    ('onliner', 'scrapers.onliner_scraper', 'OnlinerScraper', (10, 5, 120, 900), ['onliner_details'], ''),
+    ('realt', 'scrapers.realt_scraper', 'RealtScraper', (60, 30, 600, 120), [], 'REALT UPDATE\n'),
+    ('kvartirant', 'scrapers.kvartirant_scraper_new', 'KvartirantScraper', (60, 30, 600, 400), [],
+     'KVARTIRANT UPDATE\n'),  # site changed
+]
+
+KEY = get_config().get('bot_key')
+
+readiness = OrderedDict((source[0], 'waiting') for source in SOURCES)  # source -> state shown by /status
+schedules = OrderedDict()  # source -> AdaptiveSchedule, once the scraper is built
+subscriptions = None  # Subscriptions, made in main()
+duplicates = Duplicates()
+listing_index = ListingIndex()  # recent listings of all the sources for /find
+sender = None  # SendQueue of the bot, made in main()
+
+_fetcher_lock = threading.Lock()
+
+
+def fetcher():
+    """Shared fetcher, on the first call it is started with the archive recorder if "archive_dir" is set"""
+    from scrapers.http_client import get_fetcher  # aiohttp is imported by the first warm-up thread, not at start
+    with _fetcher_lock:
+        shared = get_fetcher()
+        archive_dir = get_config().get('archive_dir')
+        if archive_dir and shared.recorder is None:  # raw responses for benchmarks.replay
+            from scrapers.archive import ArchiveWriter
+            shared.recorder = ArchiveWriter(archive_dir)
+    return shared
+
+
+def deliver(scraper, header: str, listings: list) -> None:
+    """
+    Dedup the listings, match them with the chat filters and queue the messages. A flat the chat was already
+    alerted on from another site comes as links only, any other chat gets the full alert
+    """
+    from scrapers.render import RENDERERS, render_links
+    metrics = get_metrics()
+    listing_index.add(listings)
+    with metrics.stage(scraper.SOURCE, 'dedup'):
+        flats = duplicates.merge(listings)
+    with metrics.stage(scraper.SOURCE, 'fan_out'):
+        by_chat = subscriptions.fan_out(listings)
+    with metrics.stage(scraper.SOURCE, 'render'):  # once per listing, not per chat
+        texts = {listing: RENDERERS[listing.source](listing) for listing in listings}
+        links = {listing: render_links(listing.links) for listing in listings if listing.links}
+    for chat_id, chat_listings in by_chat.items():  # sent by the queue worker, the tick doesn't wait for it
+        sender.put(chat_id, [links[listing] if duplicates.alerted(flats[listing], chat_id) and listing in links
+                             else texts[listing] for listing in chat_listings], header)
+
+
+def handle(scraper, header: str, listings: list, cold: bool) -> None:
+    """Listings of a tick: alerted, or only stored while the source is cold (see warm_up)"""
+    if not listings:
+        return
+    if cold:
+        listing_index.add(listings)  # not alerted, but can be found
+    else:
+        deliver(scraper, header, listings)
+
+
+def run_tick(bot, job) -> None:
+    """
+    Start the scraper tick on the fetcher loop and return at once. There is one tick per source for all the chats,
+    its listings are sent to the chats whose filters they match when the tick is done.
+    The next tick is scheduled only when this one is over, after the delay its schedule gives.
+    Until the first tick of a cold start succeeds, its listings are only stored (see warm_up).
+    """
+    scraper, schedule, header, cold = job.context
+    metrics = get_metrics()
+    started = perf_counter()
+
+    def done(fut):
+        elapsed = perf_counter() - started
+        metrics.observe(scraper.SOURCE, 'tick', elapsed)
+        try:
+            listings = fut.result()
+        except Exception as e:
+            metrics.count(scraper.SOURCE, 'errors')
+            print(datetime.now(), type(scraper).__name__, 'tick failed:', repr(e))
+            job.job_queue.run_once(run_tick, schedule.failure(getattr(e, 'retry_after', None)), context=job.context)
+            return
+        job.job_queue.run_once(run_tick, schedule.success(elapsed), context=(scraper, schedule, header, False))
+        handle(scraper, header, listings, cold)
+
+    fetcher().submit(scraper.listings_async()).add_done_callback(done)
+
+
+def warm_up(job_queue, source: tuple) -> None:
+    """
+    Build the scraper and run its first tick, then start its regular ticks. Every source has its own thread.
+    On a cold start (nothing stored for the source yet) the first successful tick only fills the seen listings,
+    so the chats don't get everything that is on the site at once.
+    """
+    name, module, class_name, limits, counted, header = source
+    readiness[name] = 'warming up'
+    started = perf_counter()
+    try:
+        scraper = getattr(import_module(module), class_name)()
+    except Exception as e:
+        readiness[name] = 'failed: {!r}'.format(e)
+        print(datetime.now(), name, 'failed to start:', repr(e))
+        return
+    schedule = schedules[name] = AdaptiveSchedule(scraper.SOURCE, *limits, counted=counted)
+    cold = not scraper.store.has_source(scraper.SOURCE)
+    try:
+        listings = fetcher().run(scraper.listings_async())
+    except Exception as e:
+        get_metrics().count(scraper.SOURCE, 'errors')
+        print(datetime.now(), name, 'first tick failed:', repr(e))
+        delay = schedule.failure(getattr(e, 'retry_after', None))
+        readiness[name] = 'ready, the first tick failed'
+    else:
+        delay = schedule.success(perf_counter() - started)
+        handle(scraper, header, listings, cold)
+        cold = False  # the seen listings are filled, the next ticks alert
+        readiness[name] = 'ready in {:.1f}s'.format(perf_counter() - started)
+    job_queue.run_once(run_tick, delay, context=(scraper, schedule, header, cold))
+
+
+def status_text() -> str:
+    return '\n'.join('{}: {}'.format(name, state) for name, state in readiness.items())
+
+
+def start(bot, update, args):
+    """Subscribe the chat, the arguments are its filter: /start 2_room 300-500 owner уручье"""
+    chat_filter = ChatFilter.parse(args)
+    subscriptions.subscribe(update.message.chat_id, chat_filter)
+    reply = 'bot active, filter: {}'.format(chat_filter)
+    if not all(state.startswith('ready') for state in readiness.values()):
+        reply += '\n' + status_text()  # alerts of the sources still warming up come a bit later
+    update.message.reply_text(reply)
+
+
+def stop(bot, update):
+    if subscriptions.unsubscribe(update.message.chat_id):
+        update.message.reply_text('bot disabled')
+    else:
+        update.message.reply_text('bot is not active in this chat')
+
+
+def find(bot, update, args):
+    """Search the recent listings, the arguments are a filter as in /start plus site names: /find 2_room <400 owner"""
+    from scrapers.render import RENDERERS
+    started = perf_counter()
+    chat_filter, sources = parse_query(args)
+    total, listings = listing_index.find(chat_filter, sources)
+    get_metrics().observe('bot', 'find', perf_counter() - started)
+    if not listings:
+        update.message.reply_text('nothing found for: {}'.format(chat_filter))
+        return
+    header = 'found {}, the newest {}:\n'.format(total, len(listings))
+    sender.put(update.message.chat_id, [RENDERERS[listing.source](listing) for listing in listings], header)
+
+
+def status(bot, update):
+    """Readiness of the scrapers"""
+    update.message.reply_text(status_text())
+
+
+def stats(bot, update):
+    """Polling intervals, stage timings and counters of the scrapers"""
+    # warm-up threads add to schedules meanwhile, so iterate over a copy
+    lines = '\n'.join(str(schedule) for schedule in list(schedules.values())) + '\nmessages queued: {}'.format(len(sender))
+    # split on line boundaries by the queue, the summary grows with the sources and stages past one message
+    sender.put(update.message.chat_id, [lines + '\n' + get_metrics().summary()])
+
+
+def drop_chat(chat_id: int, error: Exception) -> None:
+    """A chat that blocked the bot or was deleted is unsubscribed, so alerts stop being matched and sent to it"""
+    if isinstance(error, Unauthorized) and subscriptions.unsubscribe(chat_id):
+        print(datetime.now(), 'chat', chat_id, 'unsubscribed:', repr(error))
+
+
+def dump_metrics(bot, job):
+    get_metrics().dump(get_config().get('metrics_file', METRICS_PATH))
+    if schedules and fetcher().recorder is not None:
+        fetcher().recorder.flush()
 
 
 def main():
-    print("Initialized, waiting for new apartments")
+    global sender, subscriptions
+    started = perf_counter()
     updater = Updater(KEY)
+    sender = SendQueue(updater.bot.send_message, permanent_errors=(BadRequest, Unauthorized),
+                       on_permanent_error=drop_chat)
+    subscriptions = Subscriptions()
     dp = updater.dispatcher
 
-    dp.add_handler(CommandHandler("start", start, pass_job_queue=True))
-    dp.add_handler(CommandHandler("stop", stop, pass_job_queue=True))
+    dp.add_handler(CommandHandler("start", start, pass_args=True))
+    dp.add_handler(CommandHandler("stop", stop))
+    dp.add_handler(CommandHandler("find", find, pass_args=True))
+    dp.add_handler(CommandHandler("status", status))
+    dp.add_handler(CommandHandler("stats", stats))
+
+    # scraping doesn't depend on the number of chats, every source warms up in parallel and then
+    # every tick schedules the next one
+    for source in SOURCES:
+        threading.Thread(target=warm_up, args=(updater.job_queue, source), name='warm-up-' + source[0],
+                         daemon=True).start()
+    updater.job_queue.run_repeating(dump_metrics, 60)  # Prometheus text file, archive flush
 
     updater.start_polling()
+    print("Initialized in {:.2f}s, waiting for new apartments".format(perf_counter() - started))
     updater.idle()
 
 
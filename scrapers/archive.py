@@ -0,0 +1,230 @@
+import asyncio
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import deque, namedtuple
+from time import time
+from typing import Callable, Dict, Deque, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from scrapers.http_client import FetchResult, HttpError, request_key, to_query
+from scrapers.metrics import get_metrics
+
+ARCHIVE_DIR = './archive'
+
+# one raw response: url is the request key (url with the query string), body is the text the scrapers got
+Record = namedtuple('Record', ['source', 'url', 'ts', 'status', 'body'])
+
+LENGTH = struct.Struct('<I')  # before every compressed record in a segment
+INDEX_ENTRY = struct.Struct('<dQI')  # time, offset of the record in the segment, its length with the prefix
+
+
+class ArchiveWriter:
+    """
+    Append-only archive of raw responses. Records are zlib-compressed one by one into segment files
+    (segment-000001.arc, ...), every segment has an index of (time, offset, length) entries next to it,
+    so a reader can jump to any record or time without decompressing what is before it.
+    """
+    def __init__(self, path: str = ARCHIVE_DIR, segment_size: int = 64 * 2 ** 20, level: int = 6):
+        self.path = path
+        self.segment_size = segment_size  # bytes, a new segment is started after this
+        self.level = level  # zlib compression level
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        segments = sorted(glob.glob(os.path.join(path, 'segment-*.arc')))
+        self._number = int(os.path.basename(segments[-1])[8:14]) if segments else 1
+        self._open()
+
+    def _open(self) -> None:
+        name = os.path.join(self.path, 'segment-{:06d}'.format(self._number))
+        self._segment = open(name + '.arc', 'ab')
+        self._index = open(name + '.idx', 'ab')
+        self._offset = self._segment.tell()
+
+    def record(self, source: str, url: str, status: int, body: str, ts: Optional[float] = None) -> None:
+        ts = time() if ts is None else ts
+        meta = json.dumps([source, url, ts, status], ensure_ascii=False)
+        data = zlib.compress((meta + '\n' + body).encode('utf-8'), self.level)
+        with self._lock:
+            if self._offset and self._offset + len(data) > self.segment_size:
+                self.close()
+                self._number += 1
+                self._open()
+            self._segment.write(LENGTH.pack(len(data)) + data)
+            self._index.write(INDEX_ENTRY.pack(ts, self._offset, LENGTH.size + len(data)))
+            self._offset += LENGTH.size + len(data)
+        get_metrics().count(source, 'archived_bytes', LENGTH.size + len(data))
+
+    def flush(self) -> None:
+        with self._lock:
+            self._segment.flush()
+            self._index.flush()
+
+    def close(self) -> None:
+        self._segment.close()
+        self._index.close()
+
+
+class ArchiveReader:
+    """Reads the records of an archive in order, segments are memory-mapped and jumped over by their indexes"""
+    def __init__(self, path: str = ARCHIVE_DIR):
+        self.path = path
+        self.segments = [name[:-4] for name in sorted(glob.glob(os.path.join(path, 'segment-*.arc')))]
+
+    @staticmethod
+    def _index(name: str):
+        times, offsets = array('d'), array('Q')
+        with open(name + '.idx', 'rb') as f:
+            data = f.read()
+        for ts, offset, _ in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+            times.append(ts)
+            offsets.append(offset)
+        return times, offsets
+
+    @staticmethod
+    def decode(data: bytes) -> Record:
+        meta, body = zlib.decompress(data).decode('utf-8').split('\n', 1)
+        source, url, ts, status = json.loads(meta)
+        return Record(source, url, ts, status, body)
+
+    def records(self, since: float = 0.0, until: float = float('inf'),
+                sources: Optional[List[str]] = None) -> Iterator[Record]:
+        for name in self.segments:
+            times, offsets = self._index(name)
+            if not times or times[-1] < since or times[0] > until:
+                continue
+            with open(name + '.arc', 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for i in range(bisect_left(times, since), len(times)):
+                    if times[i] > until:
+                        return
+                    offset = offsets[i]
+                    length = LENGTH.unpack_from(data, offset)[0]
+                    if offset + LENGTH.size + length > len(data):  # the writer was stopped in the middle
+                        return
+                    record = self.decode(data[offset + LENGTH.size:offset + LENGTH.size + length])
+                    if sources is None or record.source in sources:
+                        yield record
+
+
+class ReplayExhausted(Exception):
+    """A scraper asked for a url that has no recorded responses left"""
+
+
+def replay_key(source: str, url: str) -> Tuple[str, str]:
+    """Source and the path with the query: the host doesn't matter, so archives of the stub server replay too"""
+    parts = urlsplit(url)
+    return source, parts.path + ('?' + parts.query if parts.query else '')
+
+
+class ReplayFetcher:
+    """
+    Stands in for the AsyncFetcher (see http_client.set_fetcher): every request is answered with the next
+    recorded response to the same url, nothing goes to the network. clock gives the time of the replay,
+    pass it to the scrapers and Duplicates, so their time-based checks (e.g. RealtScraper.MAX_DAYS) see
+    the recorded time, not the current one.
+    A response is looked for among the records up to window seconds after the clock: the scrapers don't replay
+    the recorded requests exactly (e.g. a page the recording tick didn't walk), and such a request is answered
+    with a 404 instead of reading and buffering the rest of the archive. Records are read from the archive only
+    as far as the window; older responses to a url than the window before the clock are skipped, not replayed
+    out of their time. Tick the scraper that is the furthest behind in the recorded time first and resume
+    the clock at its time (see times and resume), so the window fits every scraper and nothing piles up.
+    """
+    def __init__(self, records: Iterator[Record], window: float = 900.0):
+        self._records = records
+        self.window = window  # seconds, longer than the longest polling interval of the recording
+        self._responses = {}  # type: Dict[Tuple[str, str], Deque[Record]]  # read ahead, not requested yet
+        self._pending = None  # type: Optional[Record]  # read, but past the window
+        self._exhausted = False
+        self._digests = {}  # type: Dict[Tuple[str, str], bytes]
+        self.replayed = 0
+        self.misses = 0  # requests without a recorded response in the window
+        self.now = None  # type: Optional[float]  # time of the last replayed response
+        self.times = {}  # type: Dict[str, float]  # source -> time of its last replayed response
+        self.loop = asyncio.new_event_loop()
+
+    def _peek(self) -> Optional[Record]:
+        """The next record of the archive, not buffered yet"""
+        if self._pending is None and not self._exhausted:
+            self._pending = next(self._records, None)
+            self._exhausted = self._pending is None
+        return self._pending
+
+    def _read_ahead(self, until: float) -> Optional[Record]:
+        """Buffer the next record of the archive if it is not later than until"""
+        record = self._peek()
+        if record is None or record.ts > until:
+            return None
+        self._pending = None
+        self._responses.setdefault(replay_key(record.source, record.url), deque()).append(record)
+        return record
+
+    def clock(self) -> float:
+        """Time of the last replayed response, of the first one in the archive before anything is replayed"""
+        if self.now is None:
+            record = self._peek()
+            self.now = record.ts if record is not None else time()
+        return self.now
+
+    def resume(self, source: str) -> None:
+        """Set the clock to the last response replayed for the source, before a tick of its scraper"""
+        if source in self.times:
+            self.now = self.times[source]
+
+    def skip_gap(self, source: str) -> None:
+        """
+        Move the time of the source to the next record of the archive: a tick that got no response
+        (every request missed) is in a gap of the recording, e.g. the bot was down
+        """
+        record = self._peek()
+        if record is None:
+            raise ReplayExhausted(source)
+        self.now = self.times[source] = max(self.clock(), record.ts)
+
+    def _next(self, url: str, params, source: str) -> Record:
+        key = replay_key(source, request_key(url, to_query(params)))
+        now = self.clock()
+        queue = self._responses.get(key)
+        while True:
+            while queue and queue[0].ts < now - self.window:  # not requested in its time
+                queue.popleft()
+            if queue:
+                break
+            if not self._read_ahead(now + self.window):
+                if self._exhausted:
+                    raise ReplayExhausted(key)
+                self.misses += 1
+                raise HttpError(url, 404)
+            queue = self._responses.get(key)
+        record = queue.popleft()
+        if not queue:
+            del self._responses[key]
+        self.replayed += 1
+        self.now = self.times[source] = record.ts
+        if record.status >= 400:
+            raise HttpError(url, record.status)
+        return record
+
+    async def get_text(self, url: str, headers=None, params=None, cookies=None, source: str = '') -> str:
+        return self._next(url, params, source).body
+
+    async def fetch(self, url: str, headers=None, params=None, cookies=None, source: str = '',
+                    normalize: Optional[Callable[[str], str]] = None) -> FetchResult:
+        """Same change detection as AsyncFetcher.fetch, so the scrapers short-circuit the same way"""
+        record = self._next(url, params, source)
+        key = replay_key(source, record.url)
+        body = normalize(record.body) if normalize else record.body
+        digest = hashlib.md5(body.encode('utf-8', 'replace')).digest()
+        changed = self._digests.get(key) != digest
+        self._digests[key] = digest
+        return FetchResult(record.status, record.body, changed)
+
+    def run(self, coro):
+        """Replay is CPU-bound, so the coroutine runs right here on the replay loop"""
+        return self.loop.run_until_complete(coro)
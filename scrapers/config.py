@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime
+from types import MappingProxyType
+from typing import Dict, Mapping
+
+CONFIG_PATH = './configs/config_and_cookies.json'
+
+# read-only request settings of one site: headers and cookies are mapping proxies, params is a tuple of pairs
+SourceConfig = namedtuple('SourceConfig', ['headers', 'params', 'cookies'])
+
+
+def _str_mapping(value, name: str) -> Mapping:
+    if not isinstance(value, dict) or not all(isinstance(k, str) and isinstance(v, str) for k, v in value.items()):
+        raise ValueError('{} must be an object with string values'.format(name))
+    return MappingProxyType(dict(value))
+
+
+def _params(value, name: str) -> tuple:
+    if isinstance(value, dict):
+        value = list(value.items())
+    if not isinstance(value, list) or not all(isinstance(p, (list, tuple)) and len(p) == 2 for p in value):
+        raise ValueError('{} must be a list of [key, value] pairs'.format(name))
+    return tuple((str(key), str(val)) for key, val in value)
+
+
+def parse_config(raw: Dict) -> Dict:
+    """Validate the raw json and turn every '<source>_headers/_params/_cookies' triple into a SourceConfig"""
+    if not isinstance(raw, dict):
+        raise ValueError('config must be a json object')
+    config = dict(raw)
+    sources = {key[:-len('_headers')] for key in raw if key.endswith('_headers')}
+    for source in sources:
+        config[source] = SourceConfig(_str_mapping(raw[source + '_headers'], source + '_headers'),
+                                      _params(raw.get(source + '_params', []), source + '_params'),
+                                      _str_mapping(raw.get(source + '_cookies', {}), source + '_cookies'))
+    return config
+
+
+class ConfigProvider:
+    """Parses the config file once and re-reads it only when its modification time changes"""
+    def __init__(self, path: str = CONFIG_PATH):
+        self.path = path
+        self._config = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _reload_if_changed(self) -> None:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            if self._config is None:
+                raise
+            return  # file is being replaced right now, keep the current config
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                config = parse_config(json.load(f))
+        except ValueError as e:  # broken json or bad values
+            if self._config is None:
+                raise
+            print(datetime.now(), 'config reload failed, keeping the previous one:', repr(e))
+            self._mtime = mtime  # do not re-read the same broken file on every tick
+            return
+        self._config = config
+        self._mtime = mtime
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            self._reload_if_changed()
+            return self._config.get(key, default)
+
+    def source(self, name: str) -> SourceConfig:
+        """Headers, params and cookies of the site, e.g. source('onliner')"""
+        with self._lock:
+            self._reload_if_changed()
+            return self._config[name]
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_config() -> ConfigProvider:
+    """Single config provider shared by the bot and all the scrapers"""
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            _provider = ConfigProvider()
+    return _provider
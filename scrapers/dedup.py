@@ -0,0 +1,151 @@
+import re
+import threading
+from collections import OrderedDict
+from time import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from scrapers.listing import Listing
+from scrapers.metrics import get_metrics
+
+HOUSE_RE = re.compile(r'^\s*(\d+[а-яa-z]?(?:/\d+)?)\b', re.IGNORECASE)
+WORD_RE = re.compile(r'[а-яёa-z0-9]+')
+# street types and other words that are written differently on different sites
+STREET_WORDS = frozenset(['ул', 'улица', 'пр', 'т', 'пр-т', 'проспект', 'пер', 'переулок', 'б', 'р', 'бульвар',
+                          'пл', 'площадь', 'тр', 'тракт', 'проезд', 'д', 'дом', 'минск', 'г'])
+PRICE_TOLERANCE = 0.05  # sites convert rubles at different rates, prices of one flat differ by a few percent
+
+
+def normalize_phone(phone: str) -> Optional[str]:
+    """'+375 29 123-45-67', '80291234567', '+375291234567' -> '291234567' (operator code and number)"""
+    digits = ''.join(c for c in phone if c.isdigit())
+    return digits[-9:] if len(digits) >= 9 else None
+
+
+def normalize_address(address: str) -> Optional[str]:
+    """
+    'Минск, ул. Притыцкого, 91', 'пр-т Победителей, 6', 'ул. Притыцкого, 91. 11 этаж' -> 'притыцкого|91'.
+    The street is the part before the first part starting with a house number, None if there is no house number
+    """
+    parts = (address or '').lower().replace('ё', 'е').split(',')
+    for i in range(1, len(parts)):
+        house = HOUSE_RE.match(parts[i])
+        if house is None:
+            continue
+        street = sorted(set(WORD_RE.findall(parts[i - 1])) - STREET_WORDS)
+        if street and 'комн' not in parts[i - 1]:
+            return '{}|{}'.format(' '.join(street), house.group(1))
+    return None
+
+
+def fingerprints(listing: Listing) -> Set[Tuple[str, str]]:
+    """
+    Keys the same flat gets on every site: every phone and the street with the house number, each with the rooms.
+    An agent has one phone for many flats, often with the same rooms, so a phone key only finds candidates,
+    see Flat.agrees
+    """
+    rooms = listing.rooms or ''
+    keys = {('phone', phone + '|' + rooms) for phone in filter(None, map(normalize_phone, listing.phones or ()))}
+    address = normalize_address(listing.address)
+    if address is not None:
+        keys.add(('address', address + '|' + rooms))
+    return keys
+
+
+class Flat:
+    """
+    One flat as seen on the sites: {source: url of its listing there}, when it was posted last,
+    its prices and addresses on the sites and the chats already alerted on it
+    """
+    __slots__ = ('urls', 'posted', 'prices', 'addresses', 'chats')
+
+    def __init__(self, posted: float):
+        self.urls = OrderedDict()  # type: Dict[str, str]
+        self.posted = posted
+        self.prices = set()  # type: Set[float]
+        self.addresses = set()  # type: Set[str]  # normalize_address
+        self.chats = set()  # type: Set[int]
+
+    def agrees(self, listing: Listing, address: Optional[str]) -> bool:
+        """Whether the listing found by a phone is this flat and not another flat of the same agent"""
+        if address is not None and address in self.addresses:
+            return True
+        return listing.price is not None and \
+            any(abs(listing.price - price) <= PRICE_TOLERANCE * price for price in self.prices)
+
+    def add(self, listing: Listing, address: Optional[str], now: float) -> None:
+        self.urls[listing.source] = listing.url
+        self.posted = now
+        if listing.price is not None:
+            self.prices.add(listing.price)
+        if address is not None:
+            self.addresses.add(address)
+
+
+class Duplicates:
+    """
+    Recently alerted flats by their fingerprints. A listing matching a flat already seen on another site
+    gets the links to all the sites, and a chat already alerted on the flat gets only these links
+    instead of a full repeat. Lookup and insert cost a few dict operations per listing whatever the number
+    of stored flats, plus a check of the other flats of the agent for a phone.
+    """
+    def __init__(self, ttl: float = 3 * 24 * 3600, max_size: int = 50000, clock: Callable[[], float] = None):
+        self.ttl = ttl  # seconds a flat is remembered since it was last posted
+        self.max_size = max_size  # fingerprints
+        self.clock = clock or time  # e.g. ReplayFetcher.clock
+        self._flats = OrderedDict()  # type: Dict[Tuple[str, str], List[Flat]]  # least recently posted first
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        while self._flats:
+            key, flats = next(iter(self._flats.items()))
+            if any(now - flat.posted <= self.ttl for flat in flats) and len(self._flats) <= self.max_size:
+                break
+            del self._flats[key]
+
+    def _find(self, listing: Listing, keys: Set[Tuple[str, str]], address: Optional[str],
+              now: float) -> Optional[Flat]:
+        for key in keys:
+            for flat in self._flats.get(key, ()):
+                if now - flat.posted > self.ttl:  # kept only for the other flats of the key
+                    continue
+                if key[0] == 'address' or flat.agrees(listing, address):
+                    return flat
+        return None
+
+    def merge(self, listings: List[Listing], now: Optional[float] = None) -> Dict[Listing, Flat]:
+        """
+        The flat of every listing. Listings of flats already seen on another site get links to all the sites
+        (Listing.links), see alerted for whom they are rendered as a short message
+        """
+        now = self.clock() if now is None else now
+        flats = OrderedDict()  # type: Dict[Listing, Flat]
+        with self._lock:
+            self._expire(now)
+            for listing in listings:
+                keys = fingerprints(listing)
+                address = normalize_address(listing.address)
+                flat = flats[listing] = self._find(listing, keys, address, now) or Flat(now)
+                # news on the same listing (e.g. a new price) and reposts on the same site are sent as they are
+                is_duplicate = any(source != listing.source for source in flat.urls) and \
+                    flat.urls.get(listing.source) != listing.url
+                flat.add(listing, address, now)
+                for key in keys:  # the flat may get new keys (another phone, the address) from this site
+                    # flats of the key not posted for ttl are dropped here, the others are kept for the agent
+                    key_flats = [other for other in self._flats.pop(key, ()) if other is not flat and
+                                 now - other.posted <= self.ttl]
+                    self._flats[key] = key_flats + [flat]
+                if is_duplicate:
+                    get_metrics().count(listing.source, 'duplicates')
+                    listing.links = OrderedDict(flat.urls)
+        return flats
+
+    def alerted(self, flat: Flat, chat_id: int) -> bool:
+        """Whether the chat was already alerted on the flat, from now on it is"""
+        with self._lock:
+            if chat_id in flat.chats:
+                return True
+            flat.chats.add(chat_id)
+            return False
+
+    def __len__(self) -> int:
+        return len(self._flats)
@@ -0,0 +1,67 @@
+import re
+from functools import lru_cache
+from typing import List, Optional
+
+from lxml import etree, html as lxml_html
+
+# text and attributes are read directly from lxml nodes, patterns are compiled once
+SPACES_RE = re.compile(r'\s{2,}|\n')
+PHONE_RE = re.compile(r'\+\d{3}[\s-]\d{2}[\s-]\d{3}[\s-]\d{2}[\s-]\d{2}')
+SCRIPTS_RE = re.compile(r'<script.*?</script>|<!--.*?-->', re.DOTALL | re.IGNORECASE)
+
+_EMPTY_PAGE = '<html><body></body></html>'
+
+
+def parse_html(page: str) -> lxml_html.HtmlElement:
+    """Root node of the page, an empty page gives an empty document instead of an error"""
+    if not page or not page.strip():
+        page = _EMPTY_PAGE
+    try:
+        return lxml_html.document_fromstring(page)
+    except ValueError:  # str with an xml encoding declaration, lxml wants bytes then
+        return lxml_html.document_fromstring(page.encode('utf-8'))
+
+
+@lru_cache(maxsize=None)
+def _class_xpath(tag: str, cls: str) -> etree.XPath:
+    if ' ' in cls:  # several classes - the whole attribute has to match, like in BeautifulSoup
+        return etree.XPath('//{}[@class=$cls]'.format(tag))
+    return etree.XPath('//{}[contains(concat(" ", normalize-space(@class), " "), concat(" ", $cls, " "))]'.format(tag))
+
+
+def find_by_class(root: lxml_html.HtmlElement, tag: str, cls: str) -> List[lxml_html.HtmlElement]:
+    """All the tag elements having the class (or exactly this class string if it has several classes)"""
+    return _class_xpath(tag, cls)(root, cls=cls)
+
+
+def clean_text(node: lxml_html.HtmlElement) -> str:
+    """Text of the node and its children with multiple newlines/spaces squeezed"""
+    return SPACES_RE.sub(' ', node.text_content()).strip()
+
+
+def first_link(node: lxml_html.HtmlElement) -> Optional[lxml_html.HtmlElement]:
+    """First <a href> inside the node"""
+    for link in node.iter('a'):
+        if link.get('href') is not None:
+            return link
+    return None
+
+
+def attribute_values(node: lxml_html.HtmlElement) -> List[str]:
+    """Values of all the attributes of the node and its children"""
+    return [value for element in node.iter() for value in element.attrib.values()]
+
+
+def has_class_part(node: lxml_html.HtmlElement, part: str) -> bool:
+    """Does the node or any of its children have a class containing the substring"""
+    return any(part in (element.get('class') or '') for element in node.iter())
+
+
+def find_phones(text: str) -> List[str]:
+    """Belarusian phone numbers from the text without spaces and dashes"""
+    return [phone.replace(' ', '').replace('-', '') for phone in PHONE_RE.findall(text)]
+
+
+def strip_scripts(page: str) -> str:
+    """Page without scripts and comments - they change on every load (tokens, counters) even if listings do not"""
+    return SCRIPTS_RE.sub('', page)
@@ -0,0 +1,177 @@
+import asyncio
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlencode
+
+import aiohttp
+
+from scrapers.metrics import get_metrics
+
+# status - http status, body - text of the response, changed - False if the body (or its normalized part)
+# is the same as at the previous fetch of this url, so there is no need to parse it again
+FetchResult = namedtuple('FetchResult', ['status', 'body', 'changed'])
+
+
+class HttpError(Exception):
+    """Error response of a site, retry_after is the delay the site asked for (Retry-After of a 429/503), seconds"""
+    def __init__(self, url: str, status: int, retry_after: Optional[float] = None):
+        super().__init__('{} returned {}'.format(url, status))
+        self.url = url
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AsyncFetcher:
+    """Shared pooled HTTP client running in its own event loop thread, so scrapers never block the JobQueue"""
+    def __init__(self, limit: int = 20, timeout: int = 30):
+        self.limit = limit  # max simultaneous connections in the pool
+        self.timeout = timeout  # seconds for the whole request
+        self.loop = asyncio.new_event_loop()
+        self._session = None
+        self._validators = {}  # request key -> (ETag, Last-Modified) of the previous response
+        self._bodies = {}  # request key -> previous body, returned for "304 Not Modified"
+        self._digests = {}  # request key -> hash of the previous (normalized) body
+        self.recorder = None  # ArchiveWriter, if set every response is appended to the archive
+        self._thread = threading.Thread(target=self.loop.run_forever, name='async-fetcher', daemon=True)
+        self._thread.start()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Session has to be created inside the running loop, so it is made on the first request"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def get_text(self, url: str, headers: Optional[Dict] = None, params: Optional[List] = None,
+                       cookies: Optional[Dict] = None, source: str = '') -> str:
+        """GET the url and return the body as text, HttpError if the site returned an error page"""
+        metrics = get_metrics()
+        metrics.count(source, 'requests')
+        with metrics.stage(source, 'http'):
+            async with self._get_session().get(url, headers=headers, params=to_query(params),
+                                               cookies=cookies) as response:
+                status = response.status
+                if status >= 400:  # error pages are never parsed
+                    metrics.count(source, 'http_errors')
+                    if self.recorder is not None:
+                        self.recorder.record(source, request_key(url, to_query(params)), status, '')
+                    raise HttpError(url, status, retry_after(response.headers.get('Retry-After')))
+                body = await response.text()
+        metrics.count(source, 'bytes_fetched', len(body))
+        if self.recorder is not None:
+            self.recorder.record(source, request_key(url, to_query(params)), status, body)
+        return body
+
+    async def fetch(self, url: str, headers: Optional[Dict] = None, params: Optional[List] = None,
+                    cookies: Optional[Dict] = None, source: str = '',
+                    normalize: Optional[Callable[[str], str]] = None) -> FetchResult:
+        """
+        Conditional GET: ETag/Last-Modified of the previous response are sent back to the site,
+        and the body is hashed to tell whether it has changed since the previous fetch of the url.
+        :param source: name for the counters
+        :param normalize: gives the part of the body that matters (e.g. without scripts), it is hashed instead
+        """
+        query = to_query(params)
+        key = (url, tuple(query or ()))
+        request_headers = dict(headers or {})
+        etag, last_modified = self._validators.get(key, (None, None))
+        if etag:
+            request_headers['If-None-Match'] = etag
+        if last_modified:
+            request_headers['If-Modified-Since'] = last_modified
+
+        metrics = get_metrics()
+        metrics.count(source, 'requests')
+        with metrics.stage(source, 'http'):
+            async with self._get_session().get(url, headers=request_headers, params=query,
+                                               cookies=cookies) as response:
+                status = response.status
+                if status == 304 and key in self._bodies:
+                    metrics.count(source, 'not_modified')
+                    if self.recorder is not None:  # replay gets the body the scraper got
+                        self.recorder.record(source, request_key(url, query), 200, self._bodies[key])
+                    return FetchResult(status, self._bodies[key], False)
+                if status >= 400:  # error pages are neither parsed nor remembered
+                    metrics.count(source, 'http_errors')
+                    if self.recorder is not None:
+                        self.recorder.record(source, request_key(url, query), status, '')
+                    raise HttpError(url, status, retry_after(response.headers.get('Retry-After')))
+                body = await response.text()
+                etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+        metrics.count(source, 'bytes_fetched', len(body))
+        if self.recorder is not None:
+            self.recorder.record(source, request_key(url, query), status, body)
+
+        if etag or last_modified:
+            self._validators[key] = (etag, last_modified)
+            self._bodies[key] = body
+        digest = hashlib.md5((normalize(body) if normalize else body).encode('utf-8', 'replace')).digest()
+        changed = self._digests.get(key) != digest
+        self._digests[key] = digest
+        return FetchResult(status, body, changed)
+
+    def submit(self, coro) -> Future:
+        """Schedule the coroutine on the fetcher loop without waiting for it"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """Run the coroutine on the fetcher loop and wait for the result (for the blocking main() variants)"""
+        return self.submit(coro).result()
+
+    async def _close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+    def close(self) -> None:
+        """Close the pooled session and stop the loop thread"""
+        self.run(self._close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+def retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from the Retry-After header, only the delay-seconds form is used"""
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+
+def request_key(url: str, query: Optional[List]) -> str:
+    """Url with the query string, the key of the response in the archive"""
+    if not query:
+        return url
+    return url + ('&' if '?' in url else '?') + urlencode(query)
+
+
+def to_query(params: Optional[List]) -> Optional[List]:
+    """Params in the config are a list of [key, value] pairs (requests-style), aiohttp wants str pairs"""
+    if not params:
+        return None
+    if isinstance(params, dict):
+        params = params.items()
+    return [(str(key), str(value)) for key, value in params]
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher() -> AsyncFetcher:
+    """Single fetcher (and connection pool) shared by all the scrapers"""
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = AsyncFetcher()
+    return _fetcher
+
+
+def set_fetcher(fetcher) -> None:
+    """Replace the shared fetcher, e.g. with archive.ReplayFetcher to run the scrapers on recorded responses"""
+    global _fetcher
+    with _fetcher_lock:
+        _fetcher = fetcher
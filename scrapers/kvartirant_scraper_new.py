@@ -1,78 +1,162 @@
-import requests
-from datetime import datetime
+import asyncio
 import re
-from bs4 import BeautifulSoup
-from bs4.element import Tag
-from time import sleep
-import json
+from time import sleep, time
+from typing import Callable, List, Optional, Tuple
+from scrapers.config import get_config
+from scrapers.extract import (attribute_values, clean_text, find_by_class, find_phones, first_link, parse_html,
+                              strip_scripts)
+from scrapers.http_client import get_fetcher
+from scrapers.listing import NEW, Listing, rooms_key, usd_price
+from scrapers.metrics import get_metrics
+from scrapers.parse_pool import ParseExecutor, get_parse_executor
+from scrapers.render import render_all
+from scrapers.seen_store import SeenStore, get_store
 
 
 class KvartirantScraper:
     """Get data on flats available for rent from https://r.onliner.by/ak/ according to the desired settings"""
-    def __init__(self):
-        self.seen_urls = set()
+    PAGE_URL = 'https://www.kvartirant.by/ads/flats/rent/?page={}'  # page numeration is weird here
+    MAX_PAGES = 9
+    SOURCE = 'kvartirant'
+    FULL_SWEEP_EVERY = 6 * 3600  # seconds, all the pages are re-checked this often in case something was missed
+
+    currency_regexp = re.compile(r'(\d+\$.+)')
+
+    def __init__(self, store: SeenStore = None, parse_executor: ParseExecutor = None,
+                 clock: Callable[[], float] = None):
+        self.store = store or get_store()  # seen urls, survive restarts
+        self.clock = clock or time  # e.g. ReplayFetcher.clock
+        self.parse_executor = parse_executor or get_parse_executor()  # inline or in worker processes
 
     @staticmethod
-    def clean_html(raw_html: str) -> str:
-        """Removing html tags and multiple newlines/spaces"""
-        clean_regex = re.compile('<.*?>')
-        clean_text = re.sub(clean_regex, '', raw_html)
-        clean_text = re.sub(r'(?:\n|\s{2,})', ' ', clean_text)
-        return clean_text.strip()
-
-    def construct_message(self, url: str, title: Tag, description: Tag, owner: Tag, price: Tag) -> str:
-        cleared_title = self.clean_html(str(title))
-        cleared_description = self.clean_html(str(description))
-        cleared_owner = self.clean_html(str(owner))
-        cleared_prices = self.clean_html(str(price))
-        price_currency = re.findall(r"(\d+\$.+?)\"", str(price))
-
-        return '{}\n{}\n{}\n{}\n{}\n{}'.format(url, cleared_title, cleared_description, cleared_owner,
-                                               cleared_prices, price_currency)
-
-    def main(self):
-        """Main function, constructing message if there is something worth sending"""
-        config_params = json.load(open("./configs/config_and_cookies.json", 'r'))
-        headers = config_params['kvartirant_headers']
-        params = config_params['kvartirant_params']
-        cookies = config_params['kvartirant_cookies']
-
-        url_regexp = re.compile(r"a href=\"(.+?)\"")
-
-        message = ''
-
-        session = requests.Session()
-        for page_num in range(1, 10):  # if results are on several pages
-
-            response = session.get('https://www.kvartirant.by/ads/flats/rent/?page={}'.format(page_num),
-                                   headers=headers, params=params, cookies=cookies)  # page numeration is weird here
-
-            soup = BeautifulSoup(response.text, 'html.parser')
-            titles = soup.find_all('div', {'class': 'title-obj'})
-            descriptions = soup.find_all('div', {'class': 'bottom'})
-            owners = soup.find_all('p', {'class': 'landlords'})
-            prices = soup.find_all('p', {'class': 'price'})
-
-            if not descriptions:  # page where there are no results, no point to check further
-                break
-
-            for title, description, owner, price in zip(titles, descriptions, owners, prices):
-                try:
-                    url = url_regexp.findall(str(title))[0]
-                except IndexError:
+    def parse_page(page: str) -> Optional[List[Tuple]]:
+        """
+        (url, title, description, owner, price, price in currencies) of every apartment on the page,
+        None for a page with no results
+        """
+        root = parse_html(page)
+        titles = find_by_class(root, 'div', 'title-obj')
+        descriptions = find_by_class(root, 'div', 'bottom')
+        owners = find_by_class(root, 'p', 'landlords')
+        prices = find_by_class(root, 'p', 'price')
+
+        if not descriptions:  # page where there are no results, no point to check further
+            return None
+
+        rows = []
+        for title, description, owner, price in zip(titles, descriptions, owners, prices):
+            link = first_link(title)
+            if link is None:
+                continue
+            price_currency = [found for value in attribute_values(price)
+                              for found in KvartirantScraper.currency_regexp.findall(value)]
+            rows.append((link.get('href'), clean_text(title), clean_text(description), clean_text(owner),
+                         clean_text(price), price_currency))
+        return rows
+
+    def make_listing(self, row: Tuple, found: float) -> Listing:
+        url, title, description, owner, price, price_currency = row
+        return Listing(self.SOURCE, url, url, title=title, address=title + ' ' + description,
+                       description=description, price=usd_price(' '.join(price_currency)), price_text=price,
+                       rooms=rooms_key(title), phones=tuple(find_phones(description)),
+                       owner={'собственник': True, 'агентство': False}.get(owner.lower()), found=found, flags=NEW)
+
+    def process_rows(self, rows: List[Tuple]) -> Tuple[List[Listing], int]:
+        """The apartments not seen before and the number of such apartments"""
+        found = self.clock()
+        new_urls = self.store.add_new(self.SOURCE, [row[0] for row in rows], found)  # one lookup per page
+        new_count = len(new_urls)
+        get_metrics().count(self.SOURCE, 'new_listings', new_count)
+        listings = []
+        for row in rows:
+            if row[0] in new_urls:
+                new_urls.discard(row[0])
+                listings.append(self.make_listing(row, found))
+        return listings, new_count
+
+    async def timed_parse(self, page: str) -> Optional[List[Tuple]]:
+        with get_metrics().stage(self.SOURCE, 'parse'):
+            return await self.parse_executor.run(self.parse_page, page)
+
+    def needs_full_sweep(self) -> bool:
+        """Cold start or the last full sweep was too long ago"""
+        swept_at = self.store.get_state(self.SOURCE, 'full_sweep_at')
+        return swept_at is None or self.clock() - float(swept_at) > self.FULL_SWEEP_EVERY
+
+    async def listings_async(self) -> List[Listing]:
+        """Main coroutine, every apartment not seen before as a Listing"""
+        headers, params, cookies = get_config().source('kvartirant')  # parsed once, re-read only if the file changes
+        fetcher = get_fetcher()
+        metrics = get_metrics()
+        metrics.count(self.SOURCE, 'ticks')
+
+        def get_page(page_num):
+            return fetcher.fetch(self.PAGE_URL.format(page_num), headers=headers, params=params, cookies=cookies,
+                                 source=self.SOURCE, normalize=strip_scripts)
+
+        listings = []
+        watermark = self.store.get_state(self.SOURCE, 'watermark')  # the newest url at the previous tick
+        top_url = None
+
+        if self.needs_full_sweep():
+            # all the pages are requested at once, the sweep stops at the first failed or empty page
+            pages = await asyncio.gather(*[get_page(page_num) for page_num in range(1, self.MAX_PAGES + 1)],
+                                         return_exceptions=True)
+            if isinstance(pages[0], Exception):
+                raise pages[0]  # nothing to sweep, the tick fails and is retried after a backoff
+            for i, page in enumerate(pages):
+                if isinstance(page, Exception):  # e.g. a 5xx or a page past the last one, checked at the next sweep
+                    pages = pages[:i]
+                    break
+            # changed pages are parsed at once, with the process pool they are spread over the workers;
+            # pages that didn't change since the previous fetch are already known
+            all_rows = await asyncio.gather(*[self.timed_parse(page.body) for page in pages if page.changed])
+            all_rows = iter(all_rows)
+            for page_num, page in enumerate(pages, 1):
+                if not page.changed:
                     continue
-
-                if url not in self.seen_urls:
-                    self.seen_urls.add(url)
-                    message += '-'*20 + '\n' + self.construct_message(url, title, description, owner, price) + '\n'*2
-                    print(datetime.now(), "kvartirant new apartment")
-        yield message
+                rows = next(all_rows)
+                if rows is None:
+                    break
+                if page_num == 1 and rows:
+                    top_url = rows[0][0]  # the watermark is the top of the first page only
+                listings += self.process_rows(rows)[0]
+            self.store.set_state(self.SOURCE, 'full_sweep_at', self.clock())
+        else:
+            # new ads show up on the first page, so go deeper only while pages still have unseen apartments
+            for page_num in range(1, self.MAX_PAGES + 1):
+                page = await get_page(page_num)
+                if not page.changed:  # nothing new on this page, so nothing new deeper either
+                    if page_num == 1:
+                        metrics.count(self.SOURCE, 'short_circuited')
+                    break
+                rows = await self.timed_parse(page.body)
+                if rows is None:
+                    break
+                if page_num == 1 and rows:
+                    top_url = rows[0][0]
+                page_listings, new_count = self.process_rows(rows)
+                listings += page_listings
+                if new_count == 0 or any(row[0] == watermark for row in rows):
+                    break  # the rest is older than what was already seen
+
+        if top_url and top_url != watermark:
+            self.store.set_state(self.SOURCE, 'watermark', top_url)
+        return listings
+
+    async def main_async(self) -> str:
+        """Main coroutine, constructing message if there is something worth sending"""
+        return render_all(await self.listings_async())
+
+    def main(self) -> List[Listing]:
+        """Blocking variant of listings_async. The listings of a tick come together when the whole tick is done"""
+        return get_fetcher().run(self.listings_async())
 
 
 if __name__ == '__main__':
     a = KvartirantScraper()
     while 1:
-        cnt = next(a.main())
+        cnt = render_all(a.main())
         if cnt:
             print(cnt)
         else:
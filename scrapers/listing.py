@@ -0,0 +1,59 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+ROOMS_RE = re.compile(r'(\d)-комн')
+USD_RE = re.compile(r'(\d+)\s*\$')
+
+# flags of a listing
+NEW = 1  # created or upped recently
+PRICE_CHANGED = 2  # prev_price is the price before the change
+FAKE_AGENT = 4  # says "owner", but the contact name is "агент"
+
+
+class Listing:
+    """
+    One apartment as the scrapers see it. Scrapers only fill the fields, the text of the message is made
+    by scrapers.render, so the bot can filter, dedup and batch listings without parsing any text.
+    None in a field means the site doesn't tell.
+    """
+    __slots__ = ('source', 'id', 'url', 'title', 'address', 'description', 'price', 'price_text', 'rooms',
+                 'phones', 'owner', 'created', 'updated', 'found', 'prev_price', 'flags', 'details', 'links')
+
+    def __init__(self, source: str, id: str, url: str, title: str = '', address: str = '', description: str = '',
+                 price: Optional[float] = None, price_text: str = '', rooms: Optional[str] = None,
+                 phones: Tuple[str, ...] = (), owner: Optional[bool] = None, created: Optional[float] = None,
+                 updated: Optional[float] = None, found: Optional[float] = None, prev_price: Optional[float] = None,
+                 flags: int = 0, details: List[Tuple[str, str]] = None):
+        self.source = source
+        self.id = id
+        self.url = url
+        self.title = title
+        self.address = address
+        self.description = description
+        self.price = price  # USD
+        self.price_text = price_text  # as the site shows it, e.g. '1616 руб/мес.'
+        self.rooms = rooms  # onliner-style key: 'room', '1_room', '2_room', ...
+        self.phones = phones  # '+375...' without spaces and dashes
+        self.owner = owner  # True for an owner, False for an agency
+        self.created = created  # epoch seconds
+        self.updated = updated  # epoch seconds, last time the listing was upped
+        self.found = found  # epoch seconds, when the scraper got it
+        self.prev_price = prev_price
+        self.flags = flags
+        self.details = details or []  # (field name, field text) from the detail page
+        self.links = None  # type: Optional[Dict[str, str]]  # {source: url} if the flat is on other sites too
+
+    def __repr__(self) -> str:
+        return 'Listing({!r}, {!r}, price={!r}, rooms={!r})'.format(self.source, self.id, self.price, self.rooms)
+
+
+def rooms_key(text: str) -> Optional[str]:
+    """'2-комн. квартира' / 'Сдается 2-комнатная квартира' -> '2_room'"""
+    found = ROOMS_RE.search(text or '')
+    return '{}_room'.format(found.group(1)) if found else None
+
+
+def usd_price(text: str) -> Optional[float]:
+    """'691$ в месяц' -> 691.0"""
+    found = USD_RE.search(text or '')
+    return float(found.group(1)) if found else None
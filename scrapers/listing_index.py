@@ -0,0 +1,128 @@
+import heapq
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from itertools import islice
+from time import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from scrapers.listing import Listing
+from scrapers.subscriptions import ChatFilter, tokens
+
+SOURCES = ('onliner', 'realt', 'kvartirant')
+
+
+class ListingIndex:
+    """
+    Recent listings of all the scrapers for the /find command. Every listing gets a number in the order
+    it came, the indexes map prices (sorted), rooms, owner/agency, source and street tokens to these numbers,
+    so a search is a few set operations whatever the number of stored listings.
+    A listing that comes again (e.g. with a new price) replaces the stored one.
+    """
+    def __init__(self, ttl: float = 7 * 24 * 3600, max_size: int = 50000):
+        self.ttl = ttl  # seconds a listing is kept since it came last
+        self.max_size = max_size  # listings
+        self._lock = threading.Lock()
+        self._next = 0
+        self._numbers = OrderedDict()  # type: Dict[Tuple[str, str], int]  # (source, id) -> number, oldest first
+        self._listings = {}  # type: Dict[int, Listing]
+        self._added = {}  # type: Dict[int, float]
+        self._prices = []  # type: List[Tuple[float, int]]  # (price, number), sorted
+        self._rooms = {}  # type: Dict[str, Set[int]]
+        self._owners = {True: set(), False: set()}  # type: Dict[bool, Set[int]]
+        self._sources = {}  # type: Dict[str, Set[int]]
+        self._tokens = {}  # type: Dict[str, Set[int]]
+
+    def _remove(self, number: int) -> None:
+        listing = self._listings.pop(number)
+        del self._added[number]
+        if listing.price is not None:
+            del self._prices[bisect_left(self._prices, (listing.price, number))]
+        if listing.rooms is not None:
+            self._rooms[listing.rooms].discard(number)
+        if listing.owner is not None:
+            self._owners[listing.owner].discard(number)
+        self._sources[listing.source].discard(number)
+        for token in tokens(listing.address):
+            numbers = self._tokens[token]
+            numbers.discard(number)
+            if not numbers:  # street tokens are many and rare, don't keep the empty sets
+                del self._tokens[token]
+
+    def _expire(self, now: float) -> None:
+        while self._numbers:
+            key, number = next(iter(self._numbers.items()))
+            if now - self._added[number] <= self.ttl and len(self._numbers) <= self.max_size:
+                break
+            del self._numbers[key]
+            self._remove(number)
+
+    def add(self, listings: Iterable[Listing], now: Optional[float] = None) -> None:
+        now = time() if now is None else now
+        with self._lock:
+            for listing in listings:
+                key = (listing.source, listing.id)
+                if key in self._numbers:
+                    self._remove(self._numbers.pop(key))
+                number = self._next
+                self._next += 1
+                self._numbers[key] = number
+                self._listings[number] = listing
+                self._added[number] = now
+                if listing.price is not None:
+                    insort(self._prices, (listing.price, number))
+                if listing.rooms is not None:
+                    self._rooms.setdefault(listing.rooms, set()).add(number)
+                if listing.owner is not None:
+                    self._owners[listing.owner].add(number)
+                self._sources.setdefault(listing.source, set()).add(number)
+                for token in tokens(listing.address):
+                    self._tokens.setdefault(token, set()).add(number)
+            self._expire(now)
+
+    def find(self, chat_filter: ChatFilter, sources: Iterable[str] = (), limit: int = 10) -> Tuple[int, List[Listing]]:
+        """
+        Number of the listings matching the filter and the newest of them. Unlike the alerts, a search wants
+        what it asks for: a listing without a price doesn't match a price bound, an unknown owner doesn't match
+        "owner", and so on. A district matches if any of its words is in the address.
+        """
+        with self._lock:
+            found = None  # type: Optional[Set[int]]  # None is all the listings
+
+            def narrow(numbers: Set[int]) -> None:
+                nonlocal found
+                found = set(numbers) if found is None else found & numbers
+
+            if chat_filter.min_price is not None or chat_filter.max_price is not None:
+                low = bisect_left(self._prices, (chat_filter.min_price, -1)) if chat_filter.min_price is not None \
+                    else 0
+                high = bisect_right(self._prices, (chat_filter.max_price, self._next)) \
+                    if chat_filter.max_price is not None else len(self._prices)
+                narrow({number for _, number in self._prices[low:high]})
+            if chat_filter.rooms:
+                narrow(set().union(*(self._rooms.get(key, ()) for key in chat_filter.rooms)))
+            if chat_filter.owner_only:
+                narrow(self._owners[True])
+            if sources:
+                narrow(set().union(*(self._sources.get(source, ()) for source in sources)))
+            words = tokens(' '.join(chat_filter.districts))
+            if words:  # a district of only the city or street types (e.g. "минск") is every listing
+                narrow(set().union(*(self._tokens.get(word, ()) for word in words)))
+
+            if found is None:
+                total = len(self._listings)
+                numbers = list(islice(reversed(self._numbers.values()), limit))
+            else:
+                total = len(found)
+                numbers = heapq.nlargest(limit, found)
+            return total, [self._listings[number] for number in numbers]
+
+    def __len__(self) -> int:
+        return len(self._listings)
+
+
+def parse_query(args: Iterable[str]) -> Tuple[ChatFilter, List[str]]:
+    """Arguments of /find: the chat filter syntax of /start, plus names of the sites to search, e.g. realt"""
+    args = [arg.strip().lower() for arg in args]
+    sources = [arg for arg in args if arg in SOURCES]
+    return ChatFilter.parse(arg for arg in args if arg not in SOURCES), sources
@@ -0,0 +1,124 @@
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, Tuple
+
+METRICS_PATH = './metrics.prom'
+
+
+class Histogram:
+    """Durations of the last `window` observations plus the running count and sum of all of them"""
+    def __init__(self, window: int = 512):
+        self.recent = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.recent.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, share: float) -> float:
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+class Metrics:
+    """
+    Per-source stage timings (http, parse, details, message, send, tick) and counters
+    (ticks, new_listings, errors, bytes_fetched, ...). Cheap enough to stay on in production.
+    """
+    def __init__(self, window: int = 512):
+        self.window = window
+        self._histograms = {}  # type: Dict[Tuple[str, str], Histogram]
+        self._counters = {}  # type: Dict[Tuple[str, str], int]
+        self._lock = threading.Lock()
+
+    def observe(self, source: str, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get((source, stage))
+            if histogram is None:
+                histogram = self._histograms[(source, stage)] = Histogram(self.window)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def stage(self, source: str, stage: str):
+        """Time the block: with metrics.stage('realt', 'parse'): ..."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(source, stage, perf_counter() - start)
+
+    def count(self, source: str, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[(source, name)] = self._counters.get((source, name), 0) + value
+
+    def counter(self, source: str, name: str) -> int:
+        return self._counters.get((source, name), 0)
+
+    def total(self, source: str, stage: str) -> float:
+        """Seconds spent in the stage since the start"""
+        histogram = self._histograms.get((source, stage))
+        return histogram.total if histogram is not None else 0.0
+
+    def _snapshot(self) -> Tuple[list, list]:
+        """Copies of the histograms and counters, so they can be formatted without holding the lock"""
+        with self._lock:
+            histograms = []
+            for key, h in sorted(self._histograms.items()):
+                copy = Histogram(self.window)
+                copy.recent.extend(h.recent)
+                copy.count, copy.total = h.count, h.total
+                histograms.append((key, copy))
+            return histograms, sorted(self._counters.items())
+
+    def summary(self) -> str:
+        """Human readable stats for the /stats command"""
+        histograms, counters = self._snapshot()
+        lines = []
+        for (source, stage), h in histograms:
+            lines.append('{} {}: n={} p50={:.0f}ms p99={:.0f}ms'.format(
+                source, stage, h.count, h.percentile(0.5) * 1000, h.percentile(0.99) * 1000))
+        for (source, name), value in counters:
+            lines.append('{} {}: {}'.format(source, name, value))
+        return '\n'.join(lines) or 'no stats yet'
+
+    def prometheus(self) -> str:
+        """Stats in the Prometheus text format"""
+        histograms, counters = self._snapshot()
+        lines = ['# TYPE bot_stage_seconds summary']
+        for (source, stage), h in histograms:
+            labels = 'source="{}",stage="{}"'.format(source, stage)
+            for share in (0.5, 0.9, 0.99):
+                lines.append('bot_stage_seconds{{{},quantile="{}"}} {:.6f}'.format(labels, share, h.percentile(share)))
+            lines.append('bot_stage_seconds_sum{{{}}} {:.6f}'.format(labels, h.total))
+            lines.append('bot_stage_seconds_count{{{}}} {}'.format(labels, h.count))
+        lines.append('# TYPE bot_events_total counter')
+        for (source, name), value in counters:
+            lines.append('bot_events_total{{source="{}",name="{}"}} {}'.format(source, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str = METRICS_PATH) -> None:
+        """Write the Prometheus text to the file (e.g. for the node exporter textfile collector)"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)  # readers never see a half-written file
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> Metrics:
+    """Single metrics registry shared by the bot and all the scrapers"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+    return _metrics
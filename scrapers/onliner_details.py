@@ -0,0 +1,145 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Tuple
+
+from scrapers.extract import clean_text, find_by_class, has_class_part, parse_html
+from scrapers.http_client import HttpError, get_fetcher
+from scrapers.metrics import get_metrics
+from scrapers.parse_pool import ParseExecutor, get_parse_executor
+
+# names and ids of the fields. OrderedDict is used since the first version was made on python 3.5.2
+SUBCLASSES = OrderedDict(
+    [('Номера телефонов', 'apartment-info__sub-line apartment-info__sub-line_extended-bottom_condensed-alter'),
+        ('Когда звонить',
+         'apartment-info__sub-line apartment-info__sub-line_extended apartment-info__sub-line_complementary'),
+        ('Имя контакта', 'apartment-info__sub-line apartment-info__sub-line_extended'),
+        ('Условия сдачи', 'apartment-conditions'),
+        ('Присутствует/отсутствует', 'apartment-options__item'),
+        ('Описание', 'apartment-info__sub-line apartment-info__sub-line_extended-bottom')
+     ])
+
+THROTTLED = (429, 503)  # statuses of a site asking to slow down
+
+# parsed detail page: ([(field name, field text), ...], is the "owner" actually an agent)
+Details = Tuple[List[Tuple[str, str]], bool]
+
+
+def parse_details(page: str) -> Details:
+    """Extract the SUBCLASSES fields from the apartment page on onliner"""
+    root = parse_html(page)
+
+    elements = []
+    fake_agent = False
+    for element in SUBCLASSES:
+        ls = find_by_class(root, 'div', SUBCLASSES[element])
+
+        if element == 'Присутствует/отсутствует':  # furniture, internet, balcony, TV, etc
+            temp = []
+            for item in ls:
+                if not has_class_part(item, 'lack'):
+                    is_present = '++'
+                else:
+                    is_present = '--'
+                temp.append(is_present + clean_text(item))
+            elements.append((element, '\n'.join(temp)))
+
+        elif element == 'Номера телефонов':  # where to call - in the form suitable for instant call from telegram
+            temp = []
+            for item in ls:
+                it = clean_text(item)
+                it = it.replace(' ', '').replace('-', '').replace('+', '\n+')
+                temp.append(it)
+            elements.append((element, '\n'.join(temp)))
+        else:
+            temp = [clean_text(item) for item in ls]
+            elements.append((element, '\n'.join(temp)))
+
+            if element == 'Имя контакта' and temp and temp[0].strip().lower() == 'агент':
+                fake_agent = True  # if owner name is "Агент" or something like this. Pretty common.
+    return elements, fake_agent
+
+
+class DetailCache:
+    """LRU cache with time-to-live for parsed detail pages, keyed by url"""
+    def __init__(self, max_size: int = 512, ttl: float = 3600, clock: Callable[[], float] = None):
+        self.max_size = max_size
+        self.ttl = ttl  # seconds
+        self.clock = clock or monotonic
+        self._items = OrderedDict()  # url -> (stored at, details), oldest first
+
+    def get(self, url: str) -> Optional[Details]:
+        item = self._items.get(url)
+        if item is None:
+            return None
+        stored_at, details = item
+        if self.clock() - stored_at > self.ttl:
+            del self._items[url]
+            return None
+        self._items.move_to_end(url)
+        return details
+
+    def put(self, url: str, details: Details) -> None:
+        self._items[url] = (self.clock(), details)
+        self._items.move_to_end(url)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class DetailPageFetcher:
+    """Loads and parses onliner apartment pages with limited concurrency, repeated urls are served from the cache"""
+    SOURCE = 'onliner_details'  # for the metrics
+
+    def __init__(self, concurrency: int = 4, cache_size: int = 512, ttl: float = 3600,
+                 parse_executor: ParseExecutor = None, clock: Callable[[], float] = None):
+        self.concurrency = concurrency
+        self.parse_executor = parse_executor or get_parse_executor()
+        self.cache = DetailCache(cache_size, ttl, clock)
+        self._semaphore = None  # created on the fetcher loop at the first request
+        self._in_flight = {}  # type: Dict[str, asyncio.Future]
+
+    async def _load(self, url: str) -> Details:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            page = await get_fetcher().get_text(url, source=self.SOURCE)
+        with get_metrics().stage(self.SOURCE, 'parse'):
+            details = await self.parse_executor.run(parse_details, page)
+        if any(text for _, text in details[0]):  # a page without any of the fields (e.g. a captcha) isn't cached
+            self.cache.put(url, details)
+        else:
+            get_metrics().count(self.SOURCE, 'empty_pages')
+        return details
+
+    async def get(self, url: str) -> Details:
+        """Parsed fields of the apartment page. The same url requested twice at once is loaded only once"""
+        details = self.cache.get(url)
+        if details is not None:
+            get_metrics().count(self.SOURCE, 'cache_hits')
+            return details
+        task = self._in_flight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._load(url))
+            self._in_flight[url] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(url, None))
+        return await task
+
+    async def get_many(self, urls: List[str]) -> List[Details]:
+        """
+        Parsed fields of every page, a page that failed to load gets no fields instead of failing the others.
+        When the site throttles (429/503) the error is raised: the tick fails, nothing of it is saved,
+        and the schedule backs off for the Retry-After the site asked for
+        """
+        results = await asyncio.gather(*[self.get(url) for url in urls], return_exceptions=True)
+        for url, result in zip(urls, results):
+            if isinstance(result, Exception):
+                get_metrics().count(self.SOURCE, 'errors')
+                print(datetime.now(), url, 'detail page failed:', repr(result))
+        for result in results:
+            if isinstance(result, HttpError) and result.status in THROTTLED:
+                raise result
+        return [([], False) if isinstance(result, Exception) else result for result in results]
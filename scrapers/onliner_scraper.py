@@ -1,182 +1,267 @@
-import requests
 from datetime import datetime
-from dateutil import parser
-from dateutil.tz import tzoffset
 import json
-from bs4 import BeautifulSoup
-from collections import OrderedDict
-import re
-from typing import Dict, List
-from time import sleep
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from time import sleep, time
+from scrapers.config import get_config
+from scrapers.http_client import get_fetcher
+from scrapers.listing import FAKE_AGENT, NEW, PRICE_CHANGED, Listing
+from scrapers.metrics import get_metrics
+from scrapers.onliner_details import DetailPageFetcher, Details
+from scrapers.parse_pool import ParseExecutor
+from scrapers.price_history import PriceHistory
+from scrapers.render import render_all
+from scrapers.seen_store import SeenStore, get_store
+from scrapers.timeutils import MINSK, parse_timestamp
 
 
 class OnlinerScraper:
     """Get data on flats available for rent from https://r.onliner.by/ak/ according to the desired settings"""
-    def __init__(self):
+    SEARCH_URL = 'https://ak.api.onliner.by/search/apartments'
+    SOURCE = 'onliner'
+    MAX_PAGES = 5  # search pages per tick at most
 
-        self.prices = {}  # go check were there price changes for apartments (all changes, not just price drop)
-        self.now = datetime.now(tz=tzoffset(None, 10800))
+    def __init__(self, details_concurrency: int = 4, details_cache_size: int = 512, details_ttl: float = 3600,
+                 store: SeenStore = None, parse_executor: ParseExecutor = None, clock: Callable[[], float] = None):
 
-        # names and ids of the fields. OrderedDict is used since the first version was made on python 3.5.2
-        self.subclasses = OrderedDict(
-            [('Номера телефонов', 'apartment-info__sub-line apartment-info__sub-line_extended-bottom_condensed-alter'),
-                ('Когда звонить',
-                 'apartment-info__sub-line apartment-info__sub-line_extended apartment-info__sub-line_complementary'),
-                ('Имя контакта', 'apartment-info__sub-line apartment-info__sub-line_extended'),
-                ('Условия сдачи', 'apartment-conditions'),
-                ('Присутствует/отсутствует', 'apartment-options__item'),
-                ('Описание', 'apartment-info__sub-line apartment-info__sub-line_extended-bottom')
-             ])
+        self.store = store or get_store()
+        self.clock = clock or time  # e.g. ReplayFetcher.clock
+        # price timelines to check were there price changes for apartments (all changes, not just price drop),
+        # they survive restarts
+        self.price_history = PriceHistory(self.SOURCE, self.store)
+        self.now = datetime.fromtimestamp(self.clock(), tz=MINSK)
 
-        self.message_pool = ''
+        # apartment pages, parsed fields are cached so repeated alerts for the same apartment cost no requests
+        self.details = DetailPageFetcher(details_concurrency, details_cache_size, details_ttl, parse_executor, clock)
 
-    @staticmethod
-    def clean_html(raw_html: str) -> str:
-        """Removing html tags and multiple newlines/spaces"""
-        clean_regex = re.compile('<.*?>')
-        clean_text = re.sub(clean_regex, '', raw_html)
-        clean_text = re.sub(r'(?:\n|\s{2,})', ' ', clean_text)
-        return clean_text.strip()
-
-    def check_price_changes(self, apartments: List[Dict]) -> None:
-        """Check whether some prices have changed"""
-        curr_prices = {x['id']: float(x['price']['converted']['USD']['amount']) for x in apartments}  # {id: price}
-        for i in curr_prices:
-            prev_price = self.prices.get(i)
-            if prev_price and curr_prices[i] != prev_price:
-                apartment = [x for x in apartments if x['id'] == i][0]  # id is unique, so only one apartment
-                message = self.construct_message(
-                    apartment, comment="Price changed from {} to {}!".format(prev_price, curr_prices[i]))
-
-                self.message_pool += message + '\n'*3
-        self.prices = curr_prices
-        return
-
-    def check_recent_entries(self, apartments: List[Dict], new_period: int = 12) -> None:
+        self.pending = []  # (apartment, flags, previous price) waiting for their detail pages
+        self.queued = set()  # ids of the apartments queued as new at this tick
+        self.watermark = None  # type: Optional[float]  # newest last_time_up of the previous tick
+        self.watermark_ids = set()  # type: Set[str]  # ids of the apartments upped at exactly that moment
+        self.gaps = []  # type: List[Tuple[float, Set[str], float, Set[str]]]  # see check_gaps, newest first
+        self.gap_page = 1  # page the previous capped tick stopped at
+
+    def check_price_changes(self, apartments: List[Dict]) -> Dict[str, float]:
         """
-        Check whether any of the collected apartments are new - created or upped in the last new_period seconds.
-        :param apartments: list of apartments in the form of json
-        :param new_period: period (in seconds) when the apartment is still considered as 'new'
-         and sending a message is required.
-        :return: None
+        Queue the apartments whose price has changed. Nothing is recorded here, see save_state
+        :return: {id: current price} of all the apartments
         """
+        by_id = {str(x['id']): x for x in apartments}  # id is unique, ids are stored as strings
+        curr_prices = {i: float(x['price']['converted']['USD']['amount']) for i, x in by_id.items()}  # {id: price}
+        for i, prev_price, curr_price in self.price_history.changes(curr_prices):
+            if prev_price:
+                self.pending.append((by_id[i], PRICE_CHANGED, prev_price))
+        return curr_prices
 
+    def check_new_entries(self, apartments: List[Dict]) -> bool:
+        """
+        Queue the apartments created or upped after the watermark (the newest last_time_up of the previous tick).
+        Apartments upped exactly at the watermark are told apart by their ids.
+        :param apartments: one page of apartments in the form of json, newest first
+        :return: True if the page reaches the apartments older than the watermark, so there is no need to go deeper
+        """
+        reached_old = False
         for apartment in apartments:
-            upped = parser.parse(apartment['last_time_up'])
-            upped_ago = self.now - upped
-
-            created = parser.parse(apartment['created_at'])
-            created_ago = self.now - created
-
-            if (upped_ago.days == 0 and upped_ago.seconds < new_period) or \
-                    (created_ago.days == 0 and created_ago.seconds < new_period):
-                # the newly created or upped apartment, adding its info in the message pool
-                message = self.construct_message(apartment, comment='New apartment!')
-                self.message_pool += message + '\n' * 3
-        return
-
-    def construct_message(self, apartment: Dict, comment: str = None) -> str:
-        """Converts info on apartment from json to string that can be sent as a message"""
-        rooms = {'room': 'комната', '1_room': '1-комн кв', '2_room': '2-комн кв', '3_room': '3-комн кв',
-                 '4_room': '4-комн кв'}
-        # comment can specify why the message is sent - is the apartment new, or the price has dropped
-        if comment is None:
-            initial = '-' * 20 + '\n' + '{}'.format(self.now.isoformat())
-        else:
-            initial = '-' * 20 + '\n' + '{}\n{}\n'.format(self.now.isoformat(), comment)
-        updated = 'Обновлено  ' + apartment['last_time_up']
-        created = 'Создано ' + apartment['created_at']
+            upped = parse_timestamp(apartment['last_time_up'])
+            idn = str(apartment['id'])
+            if upped < self.watermark:
+                reached_old = True
+            elif (upped > self.watermark or idn not in self.watermark_ids) and idn not in self.queued:
+                # the newly created or upped apartment, it will be sent once its detail page is loaded
+                self.pending.append((apartment, NEW, None))
+                self.queued.add(idn)  # the same apartment can show up on two pages if the list moves meanwhile
+        return reached_old
 
-        is_owner = apartment['contact']['owner']  # Owner or agency?
-        if is_owner:
-            owner = 'СОБСТВЕННИК!!!\n'
-        else:
-            owner = 'Агентство\n'
+    def check_gaps(self, apartments: List[Dict]) -> bool:
+        """
+        Queue the apartments that fall into a gap, the part of the list a capped tick didn't get to.
+        A gap is (after, ids, before, ids): apartments upped after the first moment and before the second one,
+        the ids are the apartments upped exactly at that moment which are not in the gap.
+        :return: True if the page reaches the apartments older than all the gaps
+        """
+        floor = min(after for after, _, _, _ in self.gaps)
+        reached_floor = False
+        for apartment in apartments:
+            upped = parse_timestamp(apartment['last_time_up'])
+            idn = str(apartment['id'])
+            if upped < floor:
+                reached_floor = True
+            elif idn not in self.queued and any(
+                    (upped > after or upped == after and idn not in after_ids) and
+                    (upped < before or upped == before and idn not in before_ids)
+                    for after, after_ids, before, before_ids in self.gaps):
+                self.pending.append((apartment, NEW, None))
+                self.queued.add(idn)
+        return reached_floor
+
+    def trim_gaps(self, apartments: List[Dict], reached_watermark: bool) -> None:
+        """
+        Gaps left after a capped tick: the walked apartments are cut off every gap, and if the walk didn't even
+        get to the watermark, everything between the watermark and the oldest walked apartment is a new gap
+        """
+        times = {str(x['id']): parse_timestamp(x['last_time_up']) for x in apartments}
+        oldest = min(times.values())
+        oldest_ids = {i for i, upped in times.items() if upped == oldest}
+        gaps = list(self.gaps)
+        if not reached_watermark:
+            gaps.insert(0, (self.watermark, self.watermark_ids, float('inf'), set()))
+        self.gaps = []
+        for after, after_ids, before, before_ids in gaps:
+            if oldest < after:  # walked through
+                continue
+            if oldest < before:
+                before, before_ids = oldest, oldest_ids
+            elif oldest == before:
+                before_ids = before_ids | oldest_ids
+            self.gaps.append((after, after_ids, before, before_ids))
+
+    def load_state(self) -> None:
+        watermark = self.store.get_state(self.SOURCE, 'last_time_up')
+        self.watermark = float(watermark) if watermark is not None else None
+        self.watermark_ids = set(filter(None, self.store.get_state(self.SOURCE, 'last_time_up_ids', '').split(',')))
+        gaps = json.loads(self.store.get_state(self.SOURCE, 'gaps', '[]'))
+        self.gaps = [(after, set(after_ids), before, set(before_ids)) for after, after_ids, before, before_ids in gaps]
+        self.gap_page = int(self.store.get_state(self.SOURCE, 'gap_page', '1'))
+
+    def save_state(self, apartments: List[Dict], prices: Dict[str, float]) -> None:
+        """Record the prices, the watermark and the gaps, only once the listings of the tick are made"""
+        self.price_history.update(prices, self.now.timestamp())
+        self.store.mark_seen(self.SOURCE, prices, self.now.timestamp())
+        self.move_watermark(apartments)
+        self.store.set_state(self.SOURCE, 'gaps', json.dumps([(after, sorted(after_ids), before, sorted(before_ids))
+                                                              for after, after_ids, before, before_ids in self.gaps]))
+        self.store.set_state(self.SOURCE, 'gap_page', str(self.gap_page))
 
-        url = 'URL ' + apartment['url']  # link to the apartments info on onliner
+    def move_watermark(self, apartments: List[Dict]) -> None:
+        """Persist the newest last_time_up and the ids upped at that moment"""
+        if not apartments:
+            return
+        times = {str(x['id']): parse_timestamp(x['last_time_up']) for x in apartments}
+        newest = max(times.values())
+        if self.watermark is not None and newest < self.watermark:
+            return
+        ids = {i for i, upped in times.items() if upped == newest}
+        if newest == self.watermark:
+            ids |= self.watermark_ids
+        self.store.set_state(self.SOURCE, 'last_time_up', repr(newest))
+        self.store.set_state(self.SOURCE, 'last_time_up_ids', ','.join(sorted(ids)))
 
-        address = apartment['location']['address']
+    @staticmethod
+    def page_params(params: tuple, page_num: int) -> List[Tuple[str, str]]:
+        """Config params with the page number, newest apartments first unless the config orders them otherwise"""
+        query = [(key, value) for key, value in params if key != 'page']
+        if not any(key == 'order' for key, _ in query):
+            query.append(('order', 'last_time_up:desc'))
+        return query + [('page', str(page_num))]
+
+    def make_listing(self, apartment: Dict, details: Details, flags: int, prev_price: float = None) -> Listing:
+        """Listing from the apartment json and its detail page"""
+        elements, fake_agent = details
+        # parse_details already leaves one number per line, without spaces and dashes
+        phones = tuple(phone for name, value in elements if name == 'Номера телефонов' for phone in value.split())
+        price = apartment['price']['converted']['USD']['amount']
         # sometimes there can be bugs in location/address, so check both
-        if not address:
-            address = apartment['location']['user_address']
-        address = 'Адрес ' + address
-        price = 'Цена ' + apartment['price']['converted']['USD']['amount'] + '$\n'
-        rooms = rooms.get(apartment['rent_type'], apartment['rent_type'])
-
-        resp = requests.get(apartment['url'])
-        soup = BeautifulSoup(resp.text, 'html.parser')
-
-        elements = []
-        for element in self.subclasses:
-
-            if element == 'Присутствует/отсутствует':  # furniture, internet, balcony, TV, etc
-                ls = soup.find_all('div', {'class': self.subclasses[element]})
-
-                temp = []
-                for item in ls:
-                    cnt = str(item)
-                    if 'lack' not in cnt:
-                        is_present = '++'
-                    else:
-                        is_present = '--'
-                    temp.append(is_present + self.clean_html(cnt))
-                elements.append((element, '\n'.join(temp)))
-
-            elif element == 'Номера телефонов':  # where to call - in the form suitable for instant call from telegram
-                ls = soup.find_all('div', {'class': self.subclasses[element]})
-                temp = []
-                for item in ls:
-                    it = self.clean_html(str(item))
-                    it = it.replace(' ', '').replace('-', '').replace('+', '\n+')
-                    temp.append(it)
-                elements.append((element, '\n'.join(temp)))
+        address = apartment['location']['address'] or apartment['location']['user_address']
+        return Listing(self.SOURCE, str(apartment['id']), apartment['url'], address=address, price=float(price),
+                       price_text=price, rooms=apartment['rent_type'], phones=phones,
+                       owner=bool(apartment['contact']['owner']) and not fake_agent,  # owners named "агент" aren't
+                       created=parse_timestamp(apartment['created_at']),
+                       updated=parse_timestamp(apartment['last_time_up']), found=self.now.timestamp(),
+                       prev_price=prev_price, flags=flags | (FAKE_AGENT if fake_agent else 0), details=elements)
+
+    async def listings_async(self) -> List[Listing]:
+        """
+        Main coroutine, every apartment worth sending (new or with a changed price) as a Listing.
+        The prices, the watermark and the gaps are saved only when the listings are made, so a tick that fails
+        on the way leaves nothing half-recorded and the next tick finds the same apartments again.
+        """
+        headers, params, cookies = get_config().source('onliner')  # parsed once, re-read only if the file changes
+
+        fetcher = get_fetcher()
+        metrics = get_metrics()
+        metrics.count(self.SOURCE, 'ticks')
+
+        self.now = datetime.fromtimestamp(self.clock(), tz=MINSK)
+        self.pending = []
+        self.queued = set()
+        self.load_state()
+
+        # pages are walked while they still have apartments upped after the watermark or in a gap,
+        # at most MAX_PAGES per tick. Once the watermark is reached, the walk jumps to where the previous
+        # capped tick stopped, stepping back if the list has moved up since then
+        apartments = []
+        walked = set()
+        page_num = 1
+        reached_old = False
+        jumped = False
+        covered = None  # type: Optional[int]  # walked apartments without holes above them, None is all
+        while len(walked) < self.MAX_PAGES:
+            response = await fetcher.fetch(self.SEARCH_URL, headers=headers, params=self.page_params(params, page_num),
+                                           cookies=cookies, source=self.SOURCE)
+            walked.add(page_num)
+            # same json as at the previous fetch - nothing new, nothing re-priced, unless a gap is still to be walked
+            if not response.changed and not self.gaps:
+                if page_num == 1:
+                    metrics.count(self.SOURCE, 'short_circuited')
+                break
+            with metrics.stage(self.SOURCE, 'parse'):
+                response_json = json.loads(response.body)
+                page = response_json['apartments']
+                apartments += page
+                if self.watermark is None:  # cold start: everything is old, only the watermark is set
+                    break
+                reached_old = self.check_new_entries(page) or reached_old  # are there any new apartments?
+                reached_floor = self.check_gaps(page) if self.gaps else True
+            if jumped and covered is not None:  # the page after the jump, there may be a hole above it
+                if page_num - 1 not in walked and page and \
+                        parse_timestamp(page[0]['last_time_up']) < self.gaps[0][2]:
+                    page_num -= 1  # the top of the newest gap is on an earlier page
+                    continue
+                covered = None
+            last_page = response_json.get('page', {}).get('last', page_num)
+            if page_num >= last_page or reached_old and reached_floor:
+                self.gaps = []  # every gap is walked through
+                break
+            if reached_old and not jumped:
+                jumped, covered = True, len(apartments)
+                page_num = min(max(page_num + 1, self.gap_page), last_page)
             else:
-                ls = soup.find_all('div', {'class': self.subclasses[element]})
-                temp = []
-                for item in ls:
-                    temp.append(self.clean_html(str(item)))
-                elements.append((element, '\n'.join(temp)))
-
-                if element == 'Имя контакта' and temp[0].strip().lower() == 'агент':
-                    owner = 'Лживое агентство'  # if owner name is "Агент" or something like this. Pretty common.
-        additionals = ''
-        for i in elements:
-            additionals += '\n{}\n{}\n'.format(i[0], i[1])
-        return """{}
-        {}
-        {}
-        {}
-        {}
-        {}
-        {}
-        {}
-        {}""".format(initial, updated, created, owner, url, address, price, rooms, additionals)
-
-    def main(self):
-        """Main function, constructing message if there is something worth sending"""
-        config_params = json.load(open("./configs/config_and_cookies.json", 'r'))  # this params load takes ~315 microseconds.
-        headers = config_params['onliner_headers']
-        params = config_params['onliner_params']
-        cookies = config_params['onliner_cookies']
-
-        response = requests.get('https://ak.api.onliner.by/search/apartments',
-                                headers=headers, params=params, cookies=cookies)
-        response_json = response.json()['apartments']
-
-        now = datetime.now(tz=tzoffset(None, 10800))
-        self.now = now
-        self.message_pool = ''
-
-        self.check_recent_entries(response_json)  # are there any new apartments?
-        self.check_price_changes(response_json)  # are there any apartments with changed price?
-
-        yield self.message_pool
+                page_num = max(walked) + 1
+        else:
+            metrics.count(self.SOURCE, 'page_cap_hits')  # more was upped since the previous tick than we walk
+            if apartments:
+                # the rest is walked at the next ticks, from the page this walk stopped at
+                self.trim_gaps(apartments[:covered], reached_old)
+                self.gap_page = max(walked)
+
+        if not apartments:
+            return []
+        with metrics.stage(self.SOURCE, 'parse'):
+            prices = self.check_price_changes(apartments)  # are there any apartments with changed price?
+        metrics.count(self.SOURCE, 'new_listings', len(self.pending))
+
+        # detail pages of all the apartments worth sending are loaded together (up to details.concurrency at once),
+        # a page that fails to load leaves its listing without details
+        with metrics.stage(self.SOURCE, 'details'):
+            all_details = await self.details.get_many([apartment['url'] for apartment, _, _ in self.pending])
+        listings = [self.make_listing(apartment, details, flags, prev_price)
+                    for (apartment, flags, prev_price), details in zip(self.pending, all_details)]
+        with metrics.stage(self.SOURCE, 'parse'):
+            self.save_state(apartments, prices)
+        return listings
+
+    async def main_async(self) -> str:
+        """Main coroutine, constructing message if there is something worth sending"""
+        return render_all(await self.listings_async())
+
+    def main(self) -> List[Listing]:
+        """Blocking variant of listings_async. The listings of a tick come together when the whole tick is done"""
+        return get_fetcher().run(self.listings_async())
 
 
 if __name__ == '__main__':
     scraper = OnlinerScraper()
     while 1:
-        cnt = next(scraper.main())
+        cnt = render_all(scraper.main())
         if cnt:
             print(cnt)
         else:
@@ -0,0 +1,81 @@
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+from scrapers.config import get_config
+
+
+class ParseExecutor:
+    """
+    Runs the page parsers (raw html in, small tuples out) in a process pool, so big pages neither block
+    the fetcher loop nor hold the GIL of the bot process. With 0 workers pages are parsed inline, as before.
+    The parsers have to be module-level functions or static methods, so they can be sent to the workers.
+    Workers are started by a fork server (spawned where there is none), never forked from the bot process:
+    its threads (telegram, fetcher loop, send queue) and the sqlite connection must not be copied into them.
+    A pool broken by a dead worker (OOM killer, a crash in lxml) is replaced by a new one.
+    """
+    def __init__(self, workers: int = 0):
+        self.workers = workers
+        self._pool = None  # type: Optional[ProcessPoolExecutor]
+        self._lock = threading.Lock()
+
+    def start(self) -> Optional[ProcessPoolExecutor]:
+        """
+        Start the pool and wait until the fork server and a worker are up, which takes a while,
+        so call it from a thread, not from the fetcher loop
+        """
+        if not self.workers:
+            return None
+        with self._lock:
+            if self._pool is None:
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                pool.submit(int).result()
+                self._pool = pool
+            return self._pool
+
+    def _drop(self, pool: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    async def run(self, parser: Callable, page: str):
+        if not self.workers:
+            return parser(page)
+        loop = asyncio.get_event_loop()
+        for attempt in range(2):  # the page is retried once in a new pool
+            pool = self._pool or await loop.run_in_executor(None, self.start)  # not started or dropped
+            try:
+                return await loop.run_in_executor(pool, parser, page)
+            except BrokenProcessPool:  # the pool refuses every page from now on
+                self._drop(pool)
+                if attempt:
+                    raise
+
+    def close(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_parse_executor() -> ParseExecutor:
+    """
+    Single parse executor, the number of worker processes is 'parse_workers' in the config (0 by default).
+    Its pool is started here, by the thread building the scrapers, and not by the first page on the fetcher loop
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ParseExecutor(int(get_config().get('parse_workers', 0)))
+            _executor.start()
+    return _executor
@@ -0,0 +1,93 @@
+from array import array
+from bisect import bisect_right
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+from scrapers.seen_store import SeenStore
+
+
+class PriceHistory:
+    """
+    Price timelines of listings of one source. Every listing has two parallel arrays - times and prices,
+    a point is added only when the price changes. Timelines are persisted in the SeenStore.
+    """
+    def __init__(self, source: str, store: SeenStore):
+        self.source = source
+        self.store = store
+        self._times = {}  # type: Dict[str, array]
+        self._prices = {}  # type: Dict[str, array]
+        for listing_id, ts, price in store.load_prices(source):  # warm start, rows are sorted by id and time
+            self._append(listing_id, ts, price)
+
+    def _append(self, listing_id: str, ts: float, price: float) -> None:
+        times = self._times.get(listing_id)
+        if times is None:
+            self._times[listing_id] = array('d', [ts])
+            self._prices[listing_id] = array('d', [price])
+        else:
+            times.append(ts)
+            self._prices[listing_id].append(price)
+
+    def changes(self, prices: Dict[str, float]) -> List[Tuple[str, float, float]]:
+        """Same as update, but nothing is recorded: (listing id, previous price, current price) of the changed ones"""
+        changes = []
+        for listing_id, price in prices.items():
+            known = self._prices.get(listing_id)
+            if known is not None and known[-1] != price:
+                changes.append((listing_id, known[-1], price))
+        return changes
+
+    def update(self, prices: Dict[str, float], now: Optional[float] = None) -> List[Tuple[str, float, float]]:
+        """
+        Record the current prices in one pass over them.
+        :param prices: {listing id: current price}
+        :return: (listing id, previous price, current price) of the listings whose price has changed
+        """
+        now = time() if now is None else now
+        changes = []
+        points = []
+        for listing_id, price in prices.items():
+            known = self._prices.get(listing_id)
+            if known is None or known[-1] != price:
+                if known is not None:
+                    changes.append((listing_id, known[-1], price))
+                self._append(listing_id, now, price)
+                points.append((listing_id, now, price))
+        self.store.add_prices(self.source, points)
+        return changes
+
+    def last_price(self, listing_id: str) -> Optional[float]:
+        prices = self._prices.get(listing_id)
+        return prices[-1] if prices is not None else None
+
+    def timeline(self, listing_id: str) -> List[Tuple[float, float]]:
+        """(time, price) points of the listing"""
+        return list(zip(self._times.get(listing_id, ()), self._prices.get(listing_id, ())))
+
+    def price_at(self, listing_id: str, ts: float) -> Optional[float]:
+        """Price the listing had at the moment, None if it was not known yet"""
+        times = self._times.get(listing_id)
+        if times is None:
+            return None
+        i = bisect_right(times, ts)
+        return self._prices[listing_id][i - 1] if i else None
+
+    def drops(self, since: float, min_drop: float = 0) -> List[Tuple[str, float, float]]:
+        """
+        Listings that became cheaper since the moment, biggest drop first.
+        :return: (listing id, price at the moment (or the first known one), current price)
+        """
+        found = []
+        for listing_id, times in self._times.items():
+            if times[-1] < since:  # no changes since then
+                continue
+            prices = self._prices[listing_id]
+            i = bisect_right(times, since)
+            start = prices[i - 1] if i else prices[0]
+            if start - prices[-1] > min_drop:
+                found.append((listing_id, start, prices[-1]))
+        found.sort(key=lambda x: x[2] - x[1])
+        return found
+
+    def __len__(self) -> int:
+        return len(self._times)
@@ -1,90 +1,119 @@
-import requests
 from datetime import datetime
-import json
-from bs4 import BeautifulSoup
-from bs4.element import Tag
+from lxml.html import HtmlElement
 import re
-from typing import Tuple
-from time import sleep
+from typing import Callable, List, Tuple
+from time import sleep, time
+from scrapers.config import get_config
+from scrapers.extract import clean_text, find_by_class, find_phones, first_link, parse_html, strip_scripts
+from scrapers.http_client import get_fetcher
+from scrapers.listing import NEW, Listing, rooms_key
+from scrapers.metrics import get_metrics
+from scrapers.parse_pool import ParseExecutor, get_parse_executor
+from scrapers.render import render_all
+from scrapers.seen_store import SeenStore, get_store
+from scrapers.timeutils import MINSK
 
 
 class RealtScraper:
     """Get data on flats available for rent from https://realt.by/ according to the desired settings"""
     MAX_DAYS = 3
+    SEARCH_URL = 'https://realt.by/rent/flat-for-long/'
+    SOURCE = 'realt'
 
-    def __init__(self):
-        # seen apartments will be stored here so the system won't spam with the same message
-        self.seen_apartments = set()
+    upped_regexp = re.compile(r'(Обновлено: )(.+?)( Код)')
+
+    def __init__(self, store: SeenStore = None, parse_executor: ParseExecutor = None,
+                 clock: Callable[[], float] = None):
+        # seen apartments will be stored here so the system won't spam with the same message, survives restarts
+        self.store = store or get_store()
+        self.clock = clock or time  # e.g. ReplayFetcher.clock
+        self.parse_executor = parse_executor or get_parse_executor()  # inline or in worker processes
 
     @staticmethod
-    def clean_html(raw_html: str) -> str:
-        """Removing html tags and multiple newlines/spaces"""
-        clean_regex = re.compile('<.*?>')
-        clean_text = re.sub(clean_regex, '', raw_html)
-        clean_text = re.sub(r'(?:\n|\s{2,})', ' ', clean_text)
-        return clean_text.strip()
-
-    def process_title(self, title: Tag) -> Tuple:
+    def process_title(title: HtmlElement) -> Tuple:
         """Extract id, url and address from the title"""
-        address = self.clean_html(str(title))
-        r_url = re.compile(r'(a href=")(.+?)(")')
+        address = clean_text(title)
+        link = first_link(title)
+        url = link.get('href') if link is not None else ''
         try:
-            url = r_url.findall(str(title))[0][1]
             idn = url.split('/')[-2]
         except IndexError:
             url = ''
             idn = ''
         return idn, url, address
 
-    def main(self):
-        """Main function, constructing message if there is something worth sending"""
-        config_params = json.load(open("./configs/config_and_cookies.json", 'r'))
-        headers = config_params['realt_headers']
-        params = config_params['realt_params']
-        cookies = config_params['realt_cookies']
+    @staticmethod
+    def parse_page(page: str) -> List[Tuple]:
+        """(id, url, address, description, price) of every apartment on the search page"""
+        root = parse_html(page)
+        descriptions = find_by_class(root, 'div', 'bd-item-right')
+        titles = find_by_class(root, 'div', 'title')
+        prices = find_by_class(root, 'span', 'price-byr')
+
+        rows = []
+        for i in range(len(titles)):
+            idn, url, address = RealtScraper.process_title(titles[i])
+            description = clean_text(descriptions[i]) if i < len(descriptions) else ''
+            price = clean_text(prices[i]) if i < len(prices) else ''
+            rows.append((idn, url, address, description, price))
+        return rows
+
+    async def listings_async(self) -> List[Listing]:
+        """Main coroutine, every apartment not seen before and upped in the last MAX_DAYS days as a Listing"""
+        headers, params, cookies = get_config().source('realt')  # parsed once, re-read only if the file changes
 
-        joined_message = ''
-        response = requests.get('https://realt.by/rent/flat-for-long/', headers=headers, params=params,
-                                cookies=cookies)
+        listings = []
+        fetcher = get_fetcher()
+        metrics = get_metrics()
+        metrics.count(self.SOURCE, 'ticks')
+        response = await fetcher.fetch(self.SEARCH_URL, headers=headers, params=params, cookies=cookies,
+                                       source=self.SOURCE, normalize=strip_scripts)
+        if not response.changed:  # same listings as at the previous tick, no need to parse them again
+            metrics.count(self.SOURCE, 'short_circuited')
+            return listings
 
         # all this comes info from one page, we do not enter each of the apartment info url
-        soup = BeautifulSoup(response.text, 'html.parser')
-        descriptions = soup.find_all('div', {'class': 'bd-item-right'})
-        titles = soup.find_all('div', {'class': 'title'})
-        prices = soup.find_all('span', {'class': 'price-byr'})
+        with metrics.stage(self.SOURCE, 'parse'):
+            rows = await self.parse_executor.run(self.parse_page, response.body)
+        found = self.clock()
+        today = datetime.fromtimestamp(found, tz=MINSK).date()
+        new_ids = self.store.add_new(self.SOURCE, [row[0] for row in rows], found)  # one lookup per page
+        metrics.count(self.SOURCE, 'new_listings', len(new_ids))
 
-        for i in range(len(titles)):
-            idn, url, address = self.process_title(titles[i])
-            if idn not in self.seen_apartments:  # no point in processing the apartments we have already seen
-                self.seen_apartments.add(idn)
-                description = self.clean_html(str(descriptions[i]))  # cleaning description
+        for idn, url, address, description, price in rows:
+            if idn in new_ids:  # no point in processing the apartments we have already seen
+                new_ids.discard(idn)
 
-                upped = re.findall(r'(Обновлено: )(.+?)( Код)', description)
+                upped = self.upped_regexp.findall(description)
                 try:
-                    date_upped = datetime.strptime(upped[0][1], '%d.%m.%Y').date()
-                    delta = (datetime.today().date() - date_upped).days
-                except (IndexError, TypeError):
+                    date_upped = datetime.strptime(upped[0][1], '%d.%m.%Y')
+                    delta = (today - date_upped.date()).days
+                except (IndexError, TypeError, ValueError):
                     date_upped = None
                     delta = None
 
                 if date_upped and delta <= self.MAX_DAYS:  # apartments no more than 3 days old
-                    price = self.clean_html(str(prices[i]))
+                    # price on the search page is in BYN only, so chat price filters don't apply to realt
+                    listings.append(Listing(self.SOURCE, idn, url, address=address, description=description,
+                                            price_text=price, rooms=rooms_key(address),
+                                            phones=tuple(find_phones(description)),
+                                            updated=date_upped.replace(tzinfo=MINSK).timestamp(), found=found,
+                                            flags=NEW))
+        return listings
 
-                    tel_no = re.findall(r'\+\d{3}[\s-]\d{2}[\s-]\d{3}[\s-]\d{2}[\s-]\d{2}', description)
-                    tel_no = ' '.join([x.replace(' ', '').replace('-', '') for x in tel_no])
+    async def main_async(self) -> str:
+        """Main coroutine, constructing message if there is something worth sending"""
+        return render_all(await self.listings_async())
 
-                    message = '{}\n{}\n{}\n{}\n{}\n{}\n{}\n\n'.format(
-                        '-'*20, idn, address, price, url, tel_no, upped[0][1])
-                    # adding all the required info about apartment to the message that will be sent
-                    joined_message += message
-                    # print(datetime.now(), 'realt new apartment')
-        yield joined_message
+    def main(self) -> List[Listing]:
+        """Blocking variant of listings_async. The listings of a tick come together when the whole tick is done"""
+        return get_fetcher().run(self.listings_async())
 
 
 if __name__ == '__main__':
     scraper = RealtScraper()
     while 1:
-        cnt = next(scraper.main())
+        cnt = render_all(scraper.main())
         if cnt:
             print(cnt)
         else:
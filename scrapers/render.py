@@ -0,0 +1,92 @@
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Optional
+
+from scrapers.listing import FAKE_AGENT, NEW, PRICE_CHANGED, Listing
+from scrapers.timeutils import MINSK
+
+ONLINER_ROOMS = {'room': 'комната', '1_room': '1-комн кв', '2_room': '2-комн кв', '3_room': '3-комн кв',
+                 '4_room': '4-комн кв'}
+
+
+def _time(ts: Optional[float], fmt: str = None) -> str:
+    if ts is None:
+        return ''
+    moment = datetime.fromtimestamp(ts, tz=MINSK)
+    return moment.strftime(fmt) if fmt else moment.isoformat()
+
+
+def render_onliner(listing: Listing) -> str:
+    # comment says why the message is sent - is the apartment new, or the price has changed
+    if listing.flags & PRICE_CHANGED:
+        comment = 'Price changed from {} to {}!'.format(listing.prev_price, listing.price)
+    elif listing.flags & NEW:
+        comment = 'New apartment!'
+    else:
+        comment = None
+    if comment is None:
+        initial = '-' * 20 + '\n' + _time(listing.found)
+    else:
+        initial = '-' * 20 + '\n' + '{}\n{}\n'.format(_time(listing.found), comment)
+    updated = 'Обновлено  ' + _time(listing.updated)
+    created = 'Создано ' + _time(listing.created)
+
+    if listing.flags & FAKE_AGENT:
+        owner = 'Лживое агентство'  # if owner name is "Агент" or something like this. Pretty common.
+    elif listing.owner:
+        owner = 'СОБСТВЕННИК!!!\n'
+    else:
+        owner = 'Агентство\n'
+
+    url = 'URL ' + listing.url  # link to the apartments info on onliner
+    address = 'Адрес ' + listing.address
+    price = 'Цена ' + listing.price_text + '$\n'
+    rooms = ONLINER_ROOMS.get(listing.rooms, listing.rooms)
+
+    additionals = ''.join('\n{}\n{}\n'.format(name, text) for name, text in listing.details)
+    return """{}
+        {}
+        {}
+        {}
+        {}
+        {}
+        {}
+        {}
+        {}""".format(initial, updated, created, owner, url, address, price, rooms, additionals) + '\n' * 3
+
+
+def render_realt(listing: Listing) -> str:
+    return '{}\n{}\n{}\n{}\n{}\n{}\n{}\n\n'.format('-' * 20, listing.id, listing.address, listing.price_text,
+                                                   listing.url, ' '.join(listing.phones),
+                                                   _time(listing.updated, '%d.%m.%Y'))
+
+
+def render_kvartirant(listing: Listing) -> str:
+    owner = {True: 'Собственник', False: 'Агентство'}.get(listing.owner, '')
+    price = '{:.0f}$ в месяц'.format(listing.price) if listing.price is not None else ''
+    return '-' * 20 + '\n' + '{}\n{}\n{}\n{}\n{}\n{}'.format(
+        listing.url, listing.title, listing.description, owner, listing.price_text, price) + '\n' * 2
+
+
+def render_links(links: Dict[str, str]) -> str:
+    """Short message on a flat already alerted from another site"""
+    return '-' * 20 + '\nSame flat on several sites:\n' + '\n'.join(
+        '{}: {}'.format(source, url) for source, url in links.items()) + '\n\n'
+
+
+RENDERERS = {
+    'onliner': render_onliner,
+    'realt': render_realt,
+    'kvartirant': render_kvartirant,
+}  # type: Dict[str, Callable[[Listing], str]]
+
+
+def render(listing: Listing) -> str:
+    """Text of the message on the listing"""
+    if listing.links:
+        return render_links(listing.links)
+    return RENDERERS[listing.source](listing)
+
+
+def render_all(listings: Iterable[Listing]) -> str:
+    """All the listings in one text, joined once instead of growing a string listing by listing"""
+    return ''.join(render(listing) for listing in listings)
@@ -0,0 +1,108 @@
+import random
+from collections import deque
+from time import time
+from typing import Iterable, Optional
+
+from scrapers.metrics import get_metrics
+
+
+class AdaptiveSchedule:
+    """
+    Delay before the next tick of one source. The interval follows the arrival rate of new listings
+    (about target_new of them per tick), is never shorter than a few response times of the site,
+    backs off exponentially with jitter after errors and keeps the requests within the hourly budget.
+    Requests and new listings are taken from the metrics counters of the given sources.
+    """
+    SMOOTHING = 0.3  # weight of the latest observation in the moving averages
+    MAX_STEP = 2.0  # the interval changes at most this many times per tick
+    LATENCY_FACTOR = 5  # ticks are at least this many response times apart
+    JITTER = 0.1  # share of the interval, so the sources don't poll in lockstep
+
+    def __init__(self, source: str, interval: float, min_interval: float, max_interval: float,
+                 hourly_budget: int, counted: Iterable[str] = (), target_new: float = 1.0,
+                 max_backoff: float = 1800):
+        self.source = source
+        self.interval = interval  # seconds, current interval without backoff and jitter
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.hourly_budget = hourly_budget  # requests
+        self.counted = (source,) + tuple(counted)  # sources whose requests are paid from this budget
+        self.target_new = target_new
+        self.max_backoff = max_backoff  # seconds
+        self.rate = None  # type: Optional[float]  # new listings per second
+        self.latency = 0.0  # seconds per tick
+        self.errors = 0  # errors in a row
+        self._spent = deque()  # (time, requests) of the ticks in the last hour
+        self._last_tick = None  # type: Optional[float]
+        self._requests, self._new = self._counters()
+
+    def _counters(self):
+        metrics = get_metrics()
+        return (sum(metrics.counter(source, 'requests') for source in self.counted),
+                metrics.counter(self.source, 'new_listings'))
+
+    def _spend(self, now: float) -> int:
+        """Record the requests made since the previous call, return the number of new listings"""
+        requests, new = self._counters()
+        self._spent.append((now, requests - self._requests))
+        new_listings = new - self._new
+        self._requests, self._new = requests, new
+        while self._spent and now - self._spent[0][0] > 3600:
+            self._spent.popleft()
+        return new_listings
+
+    def spent(self) -> int:
+        """Requests in the last hour"""
+        return sum(requests for _, requests in self._spent)
+
+    def _within_budget(self, delay: float, now: float) -> float:
+        """Longer delay if the budget is used up: wait until enough of the old requests leave the hour window"""
+        over = self.spent() - self.hourly_budget
+        if over < 0:
+            return delay
+        freed = 0
+        for ts, requests in self._spent:
+            freed += requests
+            if freed > over:
+                get_metrics().count(self.source, 'budget_waits')
+                return max(delay, ts + 3600 - now)
+        return delay
+
+    def _jitter(self, delay: float) -> float:
+        return delay * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+
+    def success(self, latency: float, now: Optional[float] = None) -> float:
+        """The tick took latency seconds and went fine, returns the delay before the next one"""
+        now = time() if now is None else now
+        new_listings = self._spend(now)
+        self.errors = 0
+        self.latency = latency if not self.latency else (
+            self.SMOOTHING * latency + (1 - self.SMOOTHING) * self.latency)
+        if self._last_tick is not None and now > self._last_tick:
+            observed = new_listings / (now - self._last_tick)
+            self.rate = observed if self.rate is None else (
+                self.SMOOTHING * observed + (1 - self.SMOOTHING) * self.rate)
+        self._last_tick = now
+
+        if self.rate is not None:
+            wanted = self.target_new / self.rate if self.rate > 0 else self.max_interval
+            wanted = min(max(wanted, self.interval / self.MAX_STEP), self.interval * self.MAX_STEP)
+            floor = max(self.min_interval, self.latency * self.LATENCY_FACTOR)
+            self.interval = min(max(wanted, floor), self.max_interval)
+        return self._within_budget(self._jitter(self.interval), now)
+
+    def failure(self, retry_after: Optional[float] = None, now: Optional[float] = None) -> float:
+        """The tick failed (network error, 5xx, 429), returns the delay before the next attempt"""
+        now = time() if now is None else now
+        self._spend(now)
+        self.errors += 1
+        get_metrics().count(self.source, 'backoffs')
+        backoff = min(self.max_backoff, self.interval * 2 ** self.errors)
+        delay = random.uniform(backoff / 2, backoff)  # "equal jitter"
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return self._within_budget(delay, now)
+
+    def __str__(self) -> str:
+        return '{}: every {:.0f}s, {:.2f} new/min, {} errors in a row, {}/{} requests this hour'.format(
+            self.source, self.interval, (self.rate or 0) * 60, self.errors, self.spent(), self.hourly_budget)
@@ -0,0 +1,157 @@
+import sqlite3
+import threading
+from time import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+DB_PATH = './seen_listings.db'
+
+
+class SeenStore:
+    """
+    Listings already seen by the scrapers, kept in sqlite so restarts neither re-send alerts nor re-crawl.
+    One row per (source, listing id) with first seen / last seen time and the last known price.
+    """
+    MAX_AGE = 30 * 24 * 3600  # listings not seen for this many seconds are dropped
+    EVICT_EVERY = 3600  # seconds between eviction runs
+    BATCH = 500  # ids per "IN (...)" query, sqlite has a limit on the number of variables
+
+    def __init__(self, path: str = DB_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS listings (
+            source TEXT NOT NULL,
+            listing_id TEXT NOT NULL,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            last_price REAL,
+            PRIMARY KEY (source, listing_id)) WITHOUT ROWID""")
+        self._conn.execute('CREATE INDEX IF NOT EXISTS listings_last_seen ON listings (last_seen)')
+        # every price change of a listing, the first price included
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS price_history (
+            source TEXT NOT NULL,
+            listing_id TEXT NOT NULL,
+            ts REAL NOT NULL,
+            price REAL NOT NULL,
+            PRIMARY KEY (source, listing_id, ts)) WITHOUT ROWID""")
+        # small per-source values like crawl watermarks
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS state (
+            source TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (source, key)) WITHOUT ROWID""")
+        self._conn.commit()
+        self._last_eviction = 0.0
+
+    def lookup(self, source: str, ids: Iterable[str]) -> Dict[str, Tuple[float, float, Optional[float]]]:
+        """{listing id: (first_seen, last_seen, last_price)} for the ids that are already in the store"""
+        ids = [str(i) for i in ids]
+        found = {}
+        with self._lock:
+            for start in range(0, len(ids), self.BATCH):
+                chunk = ids[start:start + self.BATCH]
+                rows = self._conn.execute(
+                    'SELECT listing_id, first_seen, last_seen, last_price FROM listings '
+                    'WHERE source = ? AND listing_id IN ({})'.format(','.join('?' * len(chunk))),
+                    [source] + chunk)
+                for listing_id, first_seen, last_seen, last_price in rows:
+                    found[listing_id] = (first_seen, last_seen, last_price)
+        return found
+
+    def mark_seen(self, source: str, listings: Dict[str, Optional[float]], now: Optional[float] = None) -> None:
+        """Insert new listings and refresh last_seen (and last_price if given) of known ones in one batch"""
+        now = time() if now is None else now
+        # no upsert (ON CONFLICT DO UPDATE): it needs sqlite 3.24, older distributions ship 3.22
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO listings (source, listing_id, first_seen, last_seen, last_price) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(source, str(listing_id), now, now, price) for listing_id, price in listings.items()])
+            self._conn.executemany(
+                'UPDATE listings SET last_seen = ?, last_price = COALESCE(?, last_price) '
+                'WHERE source = ? AND listing_id = ?',
+                [(now, price, source, str(listing_id)) for listing_id, price in listings.items()])
+            self._conn.commit()
+        self._maybe_evict(now)
+
+    def add_new(self, source: str, ids: List[str], now: Optional[float] = None) -> Set[str]:
+        """Mark all the ids as seen and return the ones that were not in the store before"""
+        ids = [str(i) for i in ids]
+        known = self.lookup(source, ids)
+        self.mark_seen(source, dict.fromkeys(ids), now)
+        return {i for i in ids if i not in known}
+
+    def has_source(self, source: str) -> bool:
+        """Was anything stored for the source already (warm start)"""
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM listings WHERE source = ? LIMIT 1', (source,)).fetchone()
+        return row is not None
+
+    def add_prices(self, source: str, points: List[Tuple[str, float, float]]) -> None:
+        """Append (listing id, time, price) points to the price history"""
+        if not points:
+            return
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO price_history (source, listing_id, ts, price) '
+                                   'VALUES (?, ?, ?, ?)', [(source, str(i), ts, price) for i, ts, price in points])
+            self._conn.commit()
+
+    def load_prices(self, source: str) -> List[Tuple[str, float, float]]:
+        """All (listing id, time, price) points of the source ordered by id and time"""
+        with self._lock:
+            return self._conn.execute('SELECT listing_id, ts, price FROM price_history WHERE source = ? '
+                                      'ORDER BY listing_id, ts', (source,)).fetchall()
+
+    def get_state(self, source: str, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM state WHERE source = ? AND key = ?', (source, key)).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, source: str, key: str, value: str) -> None:
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO state (source, key, value) VALUES (?, ?, ?)',
+                               (source, key, str(value)))
+            self._conn.commit()
+
+    def get_states(self, source: str) -> Dict[str, str]:
+        """All {key: value} of the source"""
+        with self._lock:
+            return dict(self._conn.execute('SELECT key, value FROM state WHERE source = ?', (source,)).fetchall())
+
+    def delete_state(self, source: str, key: str) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM state WHERE source = ? AND key = ?', (source, key))
+            self._conn.commit()
+
+    def evict(self, max_age: float, now: Optional[float] = None) -> int:
+        """Drop listings not seen for max_age seconds, returns the number of dropped rows"""
+        now = time() if now is None else now
+        with self._lock:
+            deleted = self._conn.execute('DELETE FROM listings WHERE last_seen < ?', (now - max_age,)).rowcount
+            self._conn.execute('DELETE FROM price_history WHERE NOT EXISTS (SELECT 1 FROM listings l WHERE '
+                               'l.source = price_history.source AND l.listing_id = price_history.listing_id)')
+            self._conn.commit()
+        return deleted
+
+    def _maybe_evict(self, now: float) -> None:
+        if now - self._last_eviction >= self.EVICT_EVERY:
+            self._last_eviction = now
+            self.evict(self.MAX_AGE, now)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> SeenStore:
+    """Single store shared by all the scrapers"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SeenStore()
+    return _store
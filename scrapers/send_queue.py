@@ -0,0 +1,146 @@
+import heapq
+import threading
+from collections import deque
+from datetime import datetime
+from time import monotonic
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+from scrapers.metrics import get_metrics
+
+MAX_MESSAGE = 4096  # Telegram limit, characters
+
+
+def split_messages(texts: Iterable[str], header: str = '', limit: int = MAX_MESSAGE) -> List[str]:
+    """
+    Pack the listings into as few messages as possible, every one no longer than limit and starting with header.
+    A listing is split only if it doesn't fit into a message on its own, then on line boundaries where possible.
+    """
+    room = limit - len(header)
+    messages = []
+    current = ''
+    for text in texts:
+        if len(current) + len(text) <= room:
+            current += text
+            continue
+        if current:
+            messages.append(header + current)
+        current = ''
+        while len(text) > room:
+            cut = text.rfind('\n', 0, room) + 1 or room  # no line break - cut right at the limit
+            messages.append(header + text[:cut])
+            text = text[cut:]
+        current = text
+    if current:
+        messages.append(header + current)
+    return messages
+
+
+class SendQueue:
+    """
+    Outbound messages, sent by a worker thread so scraping never waits on Telegram.
+    Messages of a chat go out in order, at most one per chat_interval seconds; all the chats together
+    send at most global_rate messages per second. Failed sends are retried with exponential backoff
+    (or after the delay Telegram asked for), errors of permanent_errors types drop the message at once
+    and are passed to on_permanent_error with the chat, e.g. to unsubscribe a chat that blocked the bot.
+    """
+    SOURCE = 'telegram'  # for the metrics
+
+    def __init__(self, send: Callable[[int, str], object], chat_interval: float = 1.0, global_rate: int = 30,
+                 max_attempts: int = 5, base_delay: float = 1.0, permanent_errors: Tuple = (),
+                 on_permanent_error: Optional[Callable[[int, Exception], object]] = None):
+        self.send = send  # e.g. bot.send_message
+        self.chat_interval = chat_interval
+        self.global_rate = global_rate
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay  # seconds before the first retry
+        self.permanent_errors = permanent_errors
+        self.on_permanent_error = on_permanent_error  # called by the worker thread with (chat id, error)
+        self._chats = {}  # type: Dict[int, Deque[Tuple[str, int]]]  # chat -> (text, attempts) waiting to be sent
+        self._ready = []  # heap of (time the chat may send next, chat id), one entry per chat with messages
+        self._recent = deque()  # send times of the last second, for the global limit
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='send-queue', daemon=True)
+        self._thread.start()
+
+    def put(self, chat_id: int, texts: Iterable[str], header: str = '') -> None:
+        """Queue the listings for the chat, split into messages of the allowed size. Never blocks on sending"""
+        messages = split_messages(texts, header)
+        if not messages:
+            return
+        with self._cond:
+            waiting = self._chats.get(chat_id)
+            if waiting is None:
+                waiting = self._chats[chat_id] = deque()
+                heapq.heappush(self._ready, (monotonic(), chat_id))
+            waiting.extend((message, 0) for message in messages)
+            self._cond.notify()
+
+    def __len__(self) -> int:
+        with self._cond:
+            return sum(len(waiting) for waiting in self._chats.values())
+
+    def _next(self) -> Tuple[int, str, int]:
+        """Wait until some chat may send and the global limit allows it, then take its first message"""
+        with self._cond:
+            while True:
+                now = monotonic()
+                while self._recent and now - self._recent[0] >= 1:
+                    self._recent.popleft()
+                if not self._ready:
+                    self._cond.wait()
+                    continue
+                ready_at, chat_id = self._ready[0]
+                if len(self._recent) >= self.global_rate:
+                    ready_at = max(ready_at, self._recent[0] + 1)
+                if ready_at > now:
+                    self._cond.wait(ready_at - now)  # a new chat may be ready sooner, so wake up on put() too
+                    continue
+                heapq.heappop(self._ready)
+                text, attempts = self._chats[chat_id].popleft()
+                self._recent.append(now)
+                return chat_id, text, attempts
+
+    def _done(self, chat_id: int, delay: float, retry: Tuple[str, int] = None) -> None:
+        """Put the chat back in line, with the failed message first if it is to be retried"""
+        with self._cond:
+            waiting = self._chats[chat_id]
+            if retry is not None:
+                waiting.appendleft(retry)
+            if waiting:
+                heapq.heappush(self._ready, (monotonic() + delay, chat_id))
+            else:
+                del self._chats[chat_id]
+            self._cond.notify()
+
+    def _run(self) -> None:
+        metrics = get_metrics()
+        while True:
+            chat_id, text, attempts = self._next()
+            try:
+                with metrics.stage(self.SOURCE, 'send'):
+                    self.send(chat_id, text)
+            except self.permanent_errors as e:
+                metrics.count(self.SOURCE, 'dropped')
+                print(datetime.now(), 'message to', chat_id, 'dropped:', repr(e))
+                self._done(chat_id, self.chat_interval)
+                if self.on_permanent_error is not None:
+                    try:
+                        self.on_permanent_error(chat_id, e)
+                    except Exception as callback_error:  # the worker must keep sending to the other chats
+                        print(datetime.now(), 'permanent error handler failed:', repr(callback_error))
+            except Exception as e:
+                metrics.count(self.SOURCE, 'send_errors')
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    metrics.count(self.SOURCE, 'dropped')
+                    print(datetime.now(), 'message to', chat_id, 'dropped after', attempts, 'attempts:', repr(e))
+                    self._done(chat_id, self.chat_interval)
+                    continue
+                delay = self.base_delay * 2 ** (attempts - 1)
+                retry_after = getattr(e, 'retry_after', None)  # telegram.error.RetryAfter (flood control)
+                if retry_after is not None:
+                    delay = max(delay, float(retry_after))
+                self._done(chat_id, delay, (text, attempts))
+            else:
+                metrics.count(self.SOURCE, 'sent')
+                self._done(chat_id, self.chat_interval)
@@ -0,0 +1,171 @@
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set
+
+from scrapers.dedup import STREET_WORDS
+from scrapers.listing import Listing
+from scrapers.seen_store import SeenStore, get_store
+
+ROOMS_ARG_RE = re.compile(r'^(room|\d_room)s?$')
+RANGE_ARG_RE = re.compile(r'^(\d+)-(\d+)$')
+BOUND_ARG_RE = re.compile(r'^([<>])(\d+)$')
+TOKEN_RE = re.compile(r'\w+')
+
+STATE_SOURCE = 'subscriptions'  # chats are kept in the state table of the SeenStore: chat id -> filter text
+
+
+def tokens(text: str) -> Set[str]:
+    """
+    'Минск, ул. Притыцкого, 91' -> {'притыцкого', '91'}: words of an address or a district without street types
+    and the city, which every address has. Both the chat filters and the /find index use it, so they always agree
+    """
+    return set(TOKEN_RE.findall((text or '').lower().replace('ё', 'е'))) - STREET_WORDS
+
+
+class ChatFilter:
+    """What one chat wants to get. Empty filter lets everything through"""
+    __slots__ = ('min_price', 'max_price', 'rooms', 'owner_only', 'districts')
+
+    def __init__(self, min_price: Optional[float] = None, max_price: Optional[float] = None,
+                 rooms: Iterable[str] = (), owner_only: bool = False, districts: Iterable[str] = ()):
+        self.min_price = min_price  # USD
+        self.max_price = max_price
+        self.rooms = frozenset(rooms)  # onliner-style keys, any of them
+        self.owner_only = owner_only  # drop listings of agencies
+        self.districts = frozenset(d.lower() for d in districts)  # words any of which has to be in the address
+
+    @classmethod
+    def parse(cls, args: Iterable[str]) -> 'ChatFilter':
+        """
+        Filter from the command arguments, e.g. /start 1_room 2_room 300-500 owner уручье
+        price: 300-500, <500 or >300; rooms: room, 1_room, 2_room, ...; owner: owners only;
+        any other word is a district or a street that has to be in the address.
+        """
+        chat_filter = cls()
+        rooms, districts = set(), set()
+        for arg in args:
+            arg = arg.strip().lower()
+            if not arg:
+                continue
+            if ROOMS_ARG_RE.match(arg):
+                rooms.add(ROOMS_ARG_RE.match(arg).group(1))
+            elif RANGE_ARG_RE.match(arg):
+                low, high = RANGE_ARG_RE.match(arg).groups()
+                chat_filter.min_price, chat_filter.max_price = float(low), float(high)
+            elif BOUND_ARG_RE.match(arg):
+                sign, value = BOUND_ARG_RE.match(arg).groups()
+                if sign == '<':
+                    chat_filter.max_price = float(value)
+                else:
+                    chat_filter.min_price = float(value)
+            elif arg == 'owner':
+                chat_filter.owner_only = True
+            else:
+                districts |= tokens(arg.split('=', 1)[-1])  # district=уручье works too
+        chat_filter.rooms = frozenset(rooms)
+        chat_filter.districts = frozenset(districts)
+        return chat_filter
+
+    def args(self) -> List[str]:
+        """Inverse of parse, used to store the filter and to show it to the user"""
+        args = sorted(self.rooms)
+        if self.min_price is not None and self.max_price is not None:
+            args.append('{:.0f}-{:.0f}'.format(self.min_price, self.max_price))
+        elif self.min_price is not None:
+            args.append('>{:.0f}'.format(self.min_price))
+        elif self.max_price is not None:
+            args.append('<{:.0f}'.format(self.max_price))
+        if self.owner_only:
+            args.append('owner')
+        return args + sorted(self.districts)
+
+    def __str__(self) -> str:
+        return ' '.join(self.args()) or 'everything'
+
+
+class _Index:
+    """Immutable lookup tables built from all the filters at once, replaced as a whole on every change"""
+    def __init__(self, filters: Dict[int, ChatFilter]):
+        self.everyone = frozenset(filters)  # type: FrozenSet[int]
+
+        # chats sorted by their price bounds: the ones whose bound a listing breaks are a slice
+        min_bounds = sorted((f.min_price, chat) for chat, f in filters.items() if f.min_price is not None)
+        self.min_prices = [bound for bound, _ in min_bounds]
+        self.min_chats = [chat for _, chat in min_bounds]
+        max_bounds = sorted((f.max_price, chat) for chat, f in filters.items() if f.max_price is not None)
+        self.max_prices = [bound for bound, _ in max_bounds]
+        self.max_chats = [chat for _, chat in max_bounds]
+
+        self.rooms = {}  # type: Dict[str, Set[int]]
+        self.districts = {}  # type: Dict[str, Set[int]]
+        for chat, f in filters.items():
+            for key in f.rooms:
+                self.rooms.setdefault(key, set()).add(chat)
+            for token in f.districts:
+                self.districts.setdefault(token, set()).add(chat)
+        self.any_rooms = frozenset(chat for chat, f in filters.items() if not f.rooms)
+        self.any_district = frozenset(chat for chat, f in filters.items() if not f.districts)
+        self.owner_only = frozenset(chat for chat, f in filters.items() if f.owner_only)
+
+    def match(self, listing: Listing) -> Set[int]:
+        chats = set(self.everyone)
+        if listing.price is not None:
+            chats.difference_update(self.min_chats[bisect_right(self.min_prices, listing.price):])  # min > price
+            chats.difference_update(self.max_chats[:bisect_left(self.max_prices, listing.price)])  # max < price
+        if listing.rooms is not None and chats:
+            chats &= self.any_rooms | self.rooms.get(listing.rooms, set())
+        if listing.owner is False and chats:
+            chats -= self.owner_only
+        if listing.address and chats and self.districts:
+            wanted = set(self.any_district)
+            for token in tokens(listing.address):
+                wanted |= self.districts.get(token, set())
+            chats &= wanted
+        return chats
+
+
+class Subscriptions:
+    """
+    Chats subscribed to the alerts and their filters. Every listing is matched against all the filters
+    at once through the index, so the cost of a tick barely grows with the number of chats.
+    """
+    def __init__(self, store: SeenStore = None):
+        self.store = store or get_store()
+        self._lock = threading.Lock()
+        self._filters = {int(chat): ChatFilter.parse(value.split())
+                         for chat, value in self.store.get_states(STATE_SOURCE).items()}
+        self._index = _Index(self._filters)
+
+    def subscribe(self, chat_id: int, chat_filter: ChatFilter) -> None:
+        with self._lock:
+            self._filters[chat_id] = chat_filter
+            self._index = _Index(self._filters)
+        self.store.set_state(STATE_SOURCE, str(chat_id), ' '.join(chat_filter.args()))
+
+    def unsubscribe(self, chat_id: int) -> bool:
+        """False if the chat was not subscribed"""
+        with self._lock:
+            if self._filters.pop(chat_id, None) is None:
+                return False
+            self._index = _Index(self._filters)
+        self.store.delete_state(STATE_SOURCE, str(chat_id))
+        return True
+
+    def get(self, chat_id: int) -> Optional[ChatFilter]:
+        return self._filters.get(chat_id)
+
+    def match(self, listing: Listing) -> Set[int]:
+        """Chats that want the listing"""
+        return self._index.match(listing)  # the index is swapped as a whole, no lock needed to read it
+
+    def fan_out(self, listings: Iterable[Listing]) -> Dict[int, List[Listing]]:
+        """{chat id: its listings in the original order}"""
+        by_chat = {}  # type: Dict[int, List[Listing]]
+        for listing in listings:
+            for chat in self.match(listing):
+                by_chat.setdefault(chat, []).append(listing)
+        return by_chat
+
+    def __len__(self) -> int:
+        return len(self._filters)
@@ -0,0 +1,25 @@
+import re
+from calendar import timegm
+from datetime import timedelta, timezone
+
+MINSK = timezone(timedelta(hours=3))  # the sites show local time
+
+# 2019-02-20T12:34:56+0300, the format used by the onliner api
+ISO_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.\d+)?(?:(Z)|([+-])(\d\d):?(\d\d))?$')
+
+
+def parse_timestamp(value: str) -> float:
+    """
+    Unix time of an ISO 8601 string (UTC if there is no offset).
+    Much faster than dateutil, which is used only for unexpected formats.
+    """
+    match = ISO_RE.match(value)
+    if match is None:
+        from dateutil import parser  # slow to import, only the rare odd formats need it
+        return parser.parse(value).timestamp()
+    year, month, day, hour, minute, second, _, sign, off_hours, off_minutes = match.groups()
+    ts = timegm((int(year), int(month), int(day), int(hour), int(minute), int(second)))
+    if sign:
+        offset = int(off_hours) * 3600 + int(off_minutes) * 60
+        ts -= offset if sign == '+' else -offset
+    return float(ts)